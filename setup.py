@@ -11,5 +11,6 @@ setup(
     package_data={'uvhttp': ['example.pem']},
     include_package_data=True,
     packages=['uvhttp'],
-    install_requires=[ r.rstrip() for r in open(requirements).readlines() ]
+    install_requires=[ r.rstrip() for r in open(requirements).readlines() ],
+    extras_require={ 'json': [ 'orjson' ] }
 )
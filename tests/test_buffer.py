@@ -0,0 +1,72 @@
+from uvhttp.buffer import ResponseBuffer
+from nose.tools import *
+import time
+import tracemalloc
+
+CHUNK = b'x' * 4096
+NUM_CHUNKS = 256
+
+def test_empty_buffer():
+    buf = ResponseBuffer()
+
+    assert not buf
+    assert_equal(len(buf), 0)
+    assert_equal(buf.getvalue(), b'')
+    assert_equal(bytes(buf.memoryview()), b'')
+
+def test_chunked_buffer():
+    buf = ResponseBuffer()
+
+    buf.append(b'hello ')
+    buf.append(b'')
+    buf.append(b'world')
+
+    assert buf
+    assert_equal(len(buf), 11)
+    assert_equal(buf.getvalue(), b'hello world')
+    assert_equal(bytes(buf.memoryview()), b'hello world')
+
+    buf.append(b'!')
+    assert_equal(buf.getvalue(), b'hello world!')
+
+def test_single_chunk_is_not_copied():
+    buf = ResponseBuffer()
+    buf.append(CHUNK)
+
+    assert buf.getvalue() is CHUNK
+    assert buf.memoryview().obj is CHUNK
+
+def measure(func):
+    tracemalloc.start()
+    start_time = time.time()
+
+    func()
+
+    duration = time.time() - start_time
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return duration, peak
+
+def test_buffer_benchmark():
+    # Distinct chunk objects, as they would be when read off of a socket.
+    chunks = [ bytes(bytearray(CHUNK)) for _ in range(NUM_CHUNKS) ]
+
+    def concatenate():
+        content = b''
+        for chunk in chunks:
+            content += chunk
+        return content
+
+    def chunked():
+        buf = ResponseBuffer()
+        for chunk in chunks:
+            buf.append(chunk)
+        return buf.getvalue()
+
+    assert_equal(concatenate(), chunked())
+
+    for name, func in [ ('bytes +=', concatenate), ('chunk list', chunked) ]:
+        duration, peak = measure(func)
+        print('{}: {:.4f}s, {} bytes allocated at peak for a {} byte body'.format(
+            name, duration, peak, len(CHUNK) * NUM_CHUNKS))
@@ -1,5 +1,7 @@
 from uvhttp.utils import start_loop
 import uvhttp.dns
+import aiodns
+import asyncio
 from nose.tools import *
 import socket
 
@@ -43,6 +45,24 @@ async def test_resolve_from_cache(loop):
 
     assert_equal(result[:2], ('127.0.0.1', 80))
 
+@start_loop
+async def test_resolve_all_interleaves_families(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+
+    resolver.add_to_cache('test', 80, '127.0.0.1', 40)
+    resolver.add_to_cache('test', 80, '127.0.0.2', 40, overwrite=False)
+    resolver.add_to_cache('test', 80, '::1', 40, overwrite=False)
+
+    result = await resolver.resolve_all('test', 80)
+    assert_equal([ r[0] for r in result ], ['::1', '127.0.0.1', '127.0.0.2'])
+
+    result = await resolver.resolve('test', 80)
+    assert_equal(result[:2], ('::1', 80))
+
+    resolver.ipv6 = False
+    result = await resolver.resolve_all('test', 80)
+    assert_equal([ r[0] for r in result ], ['127.0.0.1', '::1', '127.0.0.2'])
+
 @start_loop
 async def test_resolve_failure(loop):
     resolver = uvhttp.dns.Resolver(loop)
@@ -54,6 +74,164 @@ async def test_resolve_failure(loop):
     else:
         raise AssertionError('DNS resolution should have failed!')
 
+class FakeResponse:
+    def __init__(self, host, ttl=40):
+        self.host = host
+        self.ttl = ttl
+
+class FakeDNSResolver:
+    """
+    Stands in for aiodns, answering every query after ``delay`` seconds.
+    """
+    def __init__(self, loop, delay=0.05, error=None):
+        self.loop = loop
+        self.delay = delay
+        self.error = error
+        self.queries = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def query(self, host, query_type):
+        self.queries.append((host, query_type))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        await asyncio.sleep(self.delay, loop=self.loop)
+
+        self.in_flight -= 1
+
+        if self.error:
+            raise aiodns.error.DNSError(self.error, 'fake error')
+
+        if query_type == 'AAAA':
+            return [ FakeResponse('::1') ]
+        return [ FakeResponse('127.0.0.1') ]
+
+@start_loop
+async def test_resolve_coalesces_queries(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.resolver = FakeDNSResolver(loop)
+
+    results = await asyncio.gather(*[ resolver.resolve_all('test', 80) for _ in range(100) ],
+            loop=loop)
+
+    # One AAAA and one A query, sent in parallel, answered everyone.
+    assert_equal(sorted(resolver.resolver.queries), [('test', 'A'), ('test', 'AAAA')])
+    assert_equal(resolver.resolver.max_in_flight, 2)
+    assert_equal(resolver.pending, {})
+
+    for result in results:
+        assert_equal([ r[0] for r in result ], ['::1', '127.0.0.1'])
+
+    # Later lookups are served from the cache.
+    await resolver.resolve('test', 80)
+    assert_equal(len(resolver.resolver.queries), 2)
+
+@start_loop
+async def test_negative_caching(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.resolver = FakeDNSResolver(loop, error=aiodns.error.ARES_ENOTFOUND)
+
+    for _ in range(3):
+        try:
+            await resolver.resolve('test', 80)
+        except uvhttp.dns.DNSError:
+            pass
+        else:
+            raise AssertionError('DNS resolution should have failed!')
+
+    assert_equal(len(resolver.resolver.queries), 2)
+
+    stats = resolver.stats()
+    assert_equal(stats['misses'], 1)
+    assert_equal(stats['negative_hits'], 2)
+
+    # An answer replaces the cached failure.
+    resolver.add_to_cache('test', 80, '127.0.0.1', 40)
+    result = await resolver.resolve('test', 80)
+    assert_equal(result[:2], ('127.0.0.1', 80))
+
+@start_loop
+async def test_server_errors_are_not_cached(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.resolver = FakeDNSResolver(loop, error=aiodns.error.ARES_ETIMEOUT)
+
+    for _ in range(2):
+        try:
+            await resolver.resolve('test', 80)
+        except uvhttp.dns.DNSError:
+            pass
+
+    assert_equal(len(resolver.resolver.queries), 4)
+    assert_equal(resolver.stats()['misses'], 2)
+
+@start_loop
+async def test_serve_stale(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.resolver = FakeDNSResolver(loop)
+
+    resolver.add_to_cache('test', 80, '127.0.0.2', -1)
+
+    # The expired answer is used without waiting for the refresh.
+    result = await resolver.resolve_all('test', 80)
+    assert_equal([ r[0] for r in result ], ['127.0.0.2'])
+    assert_equal(resolver.fetch_from_cache('test', 80), None)
+
+    await asyncio.sleep(0.1, loop=loop)
+
+    result = await resolver.resolve_all('test', 80)
+    assert_equal([ r[0] for r in result ], ['::1', '127.0.0.1'])
+
+    stats = resolver.stats()
+    assert_equal(stats['stale'], 1)
+    assert_equal(stats['refreshes'], 1)
+    assert_equal(stats['hits'], 1)
+    assert 'misses' not in stats
+
+@start_loop
+async def test_refresh_ahead(loop):
+    resolver = uvhttp.dns.Resolver(loop, refresh_ahead=2)
+    resolver.resolver = FakeDNSResolver(loop)
+
+    resolver.add_to_cache('test', 80, '127.0.0.2', 1)
+
+    result = await resolver.resolve_all('test', 80)
+    assert_equal([ r[0] for r in result ], ['127.0.0.2'])
+
+    await asyncio.sleep(0.1, loop=loop)
+
+    result = await resolver.resolve_all('test', 80)
+    assert_equal([ r[0] for r in result ], ['::1', '127.0.0.1'])
+    assert_equal(resolver.stats()['refreshes'], 1)
+
+@start_loop
+async def test_stale_entries_are_purged(loop):
+    resolver = uvhttp.dns.Resolver(loop, stale_ttl=0)
+
+    resolver.add_to_cache('test', 80, '127.0.0.1', -1)
+    resolver.add_to_cache('other', 80, '127.0.0.1', 40)
+
+    assert_equal(resolver.fetch_from_cache('other', 80)[:2], ('127.0.0.1', 80))
+    assert_equal(list(resolver.cached), [('other', 80)])
+    assert_equal(len(resolver.expiry), 1)
+
+@start_loop
+async def test_cache_lru_eviction(loop):
+    resolver = uvhttp.dns.Resolver(loop, cache_size=2)
+
+    resolver.add_to_cache('a', 80, '127.0.0.1', 40)
+    resolver.add_to_cache('b', 80, '127.0.0.2', 40)
+    resolver.fetch_from_cache('a', 80)
+    resolver.add_to_cache('c', 80, '127.0.0.3', 40)
+
+    assert_equal(resolver.fetch_from_cache('b', 80), None)
+    assert resolver.fetch_from_cache('a', 80)
+    assert resolver.fetch_from_cache('c', 80)
+
+    stats = resolver.stats()
+    assert_equal(stats['evictions'], 1)
+    assert_equal(stats['size'], 2)
+
 def parse_resolv_conf():
     resolvers = []
     for line in open('/etc/resolv.conf').read().split('\n'):
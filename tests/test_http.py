@@ -1,12 +1,17 @@
 from nose.tools import *
 from uvhttp.utils import start_loop
+import uvhttp.dns
 import uvhttp.http
 import uvhttp.pool
 import asyncio
+import concurrent.futures
 import functools
+import json
 import time
 import hashlib
+import socket
 import ssl
+import threading
 import zlib
 
 def md5(data):
@@ -56,6 +61,132 @@ async def test_gzipped_http_request(loop):
 
         assert not conn.locked
 
+ENCODED_BODY = b'Welcome to nginx!' * 1000
+
+def compress(coding, data):
+    if coding == b'gzip':
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    elif coding == b'deflate':
+        compressor = zlib.compressobj()
+    else:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush()
+
+class EncodingProtocol(asyncio.Protocol):
+    """
+    Responds to /gzip, /deflate and /raw with the body compressed that way,
+    sent in small chunks.
+    """
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        coding = data.split(b' ')[1][1:]
+        body = compress(coding, ENCODED_BODY)
+
+        if coding == b'raw':
+            coding = b'deflate'
+
+        self.transport.write(b'HTTP/1.1 200 OK\r\nContent-Encoding: ' + coding +
+            b'\r\nTransfer-Encoding: chunked\r\n\r\n')
+
+        for i in range(0, len(body), 7):
+            chunk = body[i:i + 7]
+            self.transport.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+
+        self.transport.write(b'0\r\n\r\n')
+
+@start_loop
+async def test_decompression(loop):
+    server = await loop.create_server(EncodingProtocol, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:{}/'.format(server.sockets[0].getsockname()[1]).encode()
+
+    session = uvhttp.http.Session(1, loop)
+
+    for coding in [ b'gzip', b'deflate', b'raw' ]:
+        response = await session.get(url + coding)
+
+        # The headers were not looked up to read the response.
+        assert_equal(response.headers.indexed, 0)
+
+        assert_equal(response.content, ENCODED_BODY)
+        assert_equal(response.text, ENCODED_BODY.decode())
+
+        response = await session.get(url + coding, stream=True)
+
+        chunks = []
+        async for chunk in response.iter_chunks():
+            chunks.append(chunk)
+
+        assert len(chunks) > 1
+        assert_equal(b''.join(chunks), ENCODED_BODY)
+
+    stats = await list(session.hosts.values())[0].stats(detailed=True)
+    assert_equal(stats['decompressed_bytes'], len(ENCODED_BODY) * 6)
+    assert stats['compressed_bytes'] < len(ENCODED_BODY)
+
+    # Without decompressing, the body is left as it was received.
+    session = uvhttp.http.Session(1, loop, decompress=False)
+
+    for coding in [ b'gzip', b'deflate', b'raw' ]:
+        response = await session.get(url + coding)
+        assert_equal(response.content, compress(coding, ENCODED_BODY))
+        assert_equal(response.text, ENCODED_BODY.decode())
+
+    server.close()
+
+def test_decompressor_short_body():
+    for coding in [ b'deflate', b'raw' ]:
+        body = compress(coding, b'')
+        decompressor = uvhttp.http.Decompressor(b'deflate')
+
+        data = b''.join(decompressor.decompress(body[i:i + 1]) for i in range(len(body)))
+        assert_equal(data + decompressor.flush(), b'')
+        assert_equal(decompressor.compressed, len(body))
+
+@start_loop
+async def test_accept_encoding(loop):
+    for accept_encoding, expected in [ (None, None), (True, 'gzip, deflate'), (b'gzip', 'gzip') ]:
+        session = uvhttp.http.Session(1, loop, accept_encoding=accept_encoding)
+
+        response = await session.get(b'http://127.0.0.1/proxy/echo')
+        assert_equal(response.json()['headers'].get('accept-encoding'), expected)
+
+        prepared = session.prepare(b'GET', b'http://127.0.0.1/proxy/echo')
+        response = await prepared.send()
+        assert_equal(response.json()['headers'].get('accept-encoding'), expected)
+
+    response = await session.get(b'http://127.0.0.1/proxy/echo', headers={
+        b'Accept-Encoding': b'identity'
+    })
+    assert_equal(response.json()['headers']['accept-encoding'], 'identity')
+
+class CookieProtocol(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(b'HTTP/1.1 200 OK\r\nSet-Cookie: a=1\r\nContent-Length: 2\r\n'
+            b'set-cookie: b=2\r\n\r\nok')
+
+@start_loop
+async def test_repeated_headers(loop):
+    server = await loop.create_server(CookieProtocol, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:{}/'.format(server.sockets[0].getsockname()[1]).encode()
+
+    session = uvhttp.http.Session(1, loop)
+    response = await session.get(url)
+
+    assert_equal(response.content, b'ok')
+    assert_equal(response.headers[b'Set-Cookie'], b'b=2')
+    assert_equal(response.headers.getall(b'set-cookie'), [ b'a=1', b'b=2' ])
+    assert_equal(response.headers.items(), [
+        (b'Set-Cookie', b'a=1'), (b'Content-Length', b'2'), (b'set-cookie', b'b=2')
+    ])
+
+    server.close()
+
 @start_loop
 async def test_http_connection_reuse(loop):
     pool_available = asyncio.Semaphore(1, loop=loop)
@@ -85,6 +216,48 @@ async def test_http_connection_reuse(loop):
 
     assert conn.connect_count == 1
 
+@start_loop
+async def test_streaming_request(loop):
+    session = uvhttp.http.Session(1, loop)
+
+    response = await session.request(b'GET', b'http://127.0.0.2/', headers={
+        b'Host': b'imgur.com'
+    })
+    expected = response.content
+
+    response = await session.request(b'GET', b'http://127.0.0.2/', headers={
+        b'Host': b'imgur.com'
+    }, stream=True)
+    assert response.status_code == 200
+    assert response.content == b''
+
+    content = b''
+    async for chunk in response.iter_chunks():
+        content += chunk
+
+    assert_equal(content, expected)
+    assert response.closed
+
+    assert await session.connections() == 1
+
+@start_loop
+async def test_streaming_request_closed_early(loop):
+    pool_available = asyncio.Semaphore(1, loop=loop)
+
+    conn = uvhttp.pool.Connection('127.0.0.2', 80, pool_available, loop)
+    conn.locked = True
+
+    request = uvhttp.http.HTTPRequest(conn)
+    await request.send(b'GET', b'imgur.com', b'/', stream=True)
+    assert request.status_code == 200
+    assert conn.locked
+
+    await request.read_chunk()
+    request.close()
+
+    assert not conn.locked
+    assert conn.writer is None
+
 @start_loop
 async def test_session(loop):
     session = uvhttp.http.Session(1, loop)
@@ -134,6 +307,538 @@ async def test_session(loop):
 
     assert await session.connections() == 3
 
+@start_loop
+async def test_session_request_limit(loop):
+    session = uvhttp.http.Session(5, loop, request_limit=2)
+
+    active = []
+
+    async def request(url):
+        response = await session.get(url)
+        active.append(session.scheduler.stats()['active'])
+        assert_equal(response.status_code, 200)
+
+    await asyncio.gather(*[ request(url) for url in [ b'http://127.0.0.1/',
+        b'http://127.0.0.1:8089/' ] * 10 ], loop=loop)
+
+    assert max(active) <= 2
+
+    stats = session.scheduler.stats()
+    assert_equal(stats['active'], 0)
+    assert_equal(stats['waiting'], 0)
+    assert stats['queued'] > 0
+
+@start_loop
+async def test_session_request_limit_connection_failure(loop):
+    session = uvhttp.http.Session(1, loop, request_limit=1)
+
+    for _ in range(2):
+        try:
+            await session.get(b'http://127.0.0.1:31337/')
+            raise AssertionError("ConnectionRefusedError was not raised.")
+        except ConnectionRefusedError:
+            pass
+
+    assert_equal(session.scheduler.stats()['active'], 0)
+
+    response = await session.get(b'http://127.0.0.1/')
+    assert_equal(response.status_code, 200)
+
+@start_loop
+async def test_session_request_limit_closes_idle(loop):
+    session = uvhttp.http.Session(5, loop, request_limit=2)
+
+    urls = [ b'http://127.0.0.1/', b'http://127.0.0.1:8089/', b'http://127.0.0.2/',
+             b'http://127.0.0.1/' ]
+
+    for url in urls:
+        response = await session.get(url)
+        assert_equal(response.status_code, 200)
+
+        open_sockets = sum(connection.connected for pool in session.hosts.values()
+            for connection in pool.pool)
+        assert open_sockets <= 2
+
+    # 127.0.0.1 was the least recently used when 127.0.0.2 needed a socket.
+    stats = session.scheduler.stats()
+    assert_equal(stats['closed_idle'], 2)
+    assert_equal(stats['idle'], 2)
+    assert_equal(stats['active'], 0)
+
+async def start_stalled_server(loop):
+    """
+    Start a server that reads requests but never responds, returning it and
+    its URL.
+    """
+    server = await loop.create_server(asyncio.Protocol, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, 'http://127.0.0.1:{}/'.format(port).encode()
+
+@start_loop
+async def test_session_read_timeout(loop):
+    server, url = await start_stalled_server(loop)
+    session = uvhttp.http.Session(1, loop, read_timeout=0.1)
+
+    for _ in range(2):
+        start = time.time()
+        try:
+            await session.get(url)
+            raise AssertionError('The request did not time out.')
+        except asyncio.TimeoutError:
+            assert time.time() - start < 0.5
+
+    pool = list(session.hosts.values())[0]
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['timeouts'], 2)
+    assert_equal(stats['connects'], 2)
+    assert not pool.pool_available.locked()
+
+    server.close()
+
+@start_loop
+async def test_session_total_timeout(loop):
+    server, url = await start_stalled_server(loop)
+    session = uvhttp.http.Session(1, loop)
+
+    start = time.time()
+    try:
+        await session.get(url, timeout=0.1)
+        raise AssertionError('The request did not time out.')
+    except asyncio.TimeoutError:
+        assert time.time() - start < 0.5
+
+    pool = list(session.hosts.values())[0]
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['timeouts'], 1)
+    assert not pool.pool_available.locked()
+    assert not pool.pool[0].connected
+
+    server.close()
+
+class SlowResolver(uvhttp.dns.Resolver):
+    """
+    Resolves every host to 127.0.0.1 after half a second.
+    """
+    async def query(self, host, port):
+        await asyncio.sleep(0.5)
+        self.add_to_cache(host, port, '127.0.0.1', 40, port=port)
+        return self.fetch_all_from_cache(host, port)
+
+@start_loop
+async def test_session_connect_timeout_resolving(loop):
+    for pool_kwargs in [ {}, { 'balance': 'least_outstanding' },
+                         { 'happy_eyeballs_delay': None } ]:
+        session = uvhttp.http.Session(1, loop, resolver=SlowResolver(loop),
+            connect_timeout=0.1, **pool_kwargs)
+
+        start = time.time()
+        try:
+            await session.get(b'http://slow.test/')
+            raise AssertionError('The request did not time out.')
+        except asyncio.TimeoutError:
+            assert time.time() - start < 0.3
+
+        pool = list(session.hosts.values())[0]
+        assert not pool.pool_available.locked()
+
+        # The lookup carried on and its result is used once it is cached.
+        await asyncio.sleep(0.5)
+        response = await session.get(b'http://slow.test/')
+        assert_equal(response.status_code, 200)
+
+@start_loop
+async def test_session_timeout_streaming(loop):
+    session = uvhttp.http.Session(1, loop, timeout=0.3)
+
+    response = await session.get(b'http://127.0.0.1/large', stream=True)
+    assert_equal(response.status_code, 200)
+
+    # The timeout covers the headers only, a slow consumer can take longer.
+    await asyncio.sleep(0.4, loop=loop)
+
+    length = 0
+    async for chunk in response.iter_chunks():
+        length += len(chunk)
+
+    assert_equal(length, int(response.headers[b'content-length']))
+    assert response.closed
+
+@start_loop
+async def test_session_sheds_queued_requests(loop):
+    server, url = await start_stalled_server(loop)
+    session = uvhttp.http.Session(1, loop)
+
+    stalled = asyncio.ensure_future(session.get(url, read_timeout=0.5), loop=loop)
+    await asyncio.sleep(0.05, loop=loop)
+
+    start = time.time()
+    try:
+        await session.get(url, timeout=0.1, priority=1)
+        raise AssertionError('The request did not time out.')
+    except asyncio.TimeoutError:
+        assert time.time() - start < 0.3
+
+    try:
+        await stalled
+    except asyncio.TimeoutError:
+        pass
+
+    pool = list(session.hosts.values())[0]
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['priorities'][1], {
+        'waiting': 0, 'served': 0, 'shed': 1, 'wait_avg': 0, 'wait_max': 0
+    })
+    assert_equal(stats['connects'], 1)
+
+    server.close()
+
+@start_loop
+async def test_session_connect_timeout(loop):
+    # A listener whose backlog is full never completes new connections.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+
+    queued = socket.socket()
+    queued.connect(listener.getsockname())
+
+    url = 'http://127.0.0.1:{}/'.format(listener.getsockname()[1]).encode()
+    session = uvhttp.http.Session(1, loop, connect_timeout=0.1)
+
+    start = time.time()
+    try:
+        await session.get(url)
+        raise AssertionError('The request did not time out.')
+    except asyncio.TimeoutError:
+        assert time.time() - start < 0.5
+
+    pool = list(session.hosts.values())[0]
+    assert not pool.pool_available.locked()
+    assert not pool.pool[0].connected
+
+    queued.close()
+    listener.close()
+
+def hedged_session(loop, port, **kwargs):
+    # The first address never responds, the second is the test server.
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.add_to_cache(b'hedgetest', 80, '127.0.0.1', 40, port=port)
+    resolver.add_to_cache(b'hedgetest', 80, '127.0.0.1', 40, port=80, overwrite=False)
+
+    return uvhttp.http.Session(2, loop, resolver=resolver, balance='least_outstanding',
+                               **kwargs)
+
+@start_loop
+async def test_session_hedging(loop):
+    server, url = await start_stalled_server(loop)
+    port = server.sockets[0].getsockname()[1]
+    session = hedged_session(loop, port, hedge_delay=0.05, hedge_rate=1)
+
+    start = time.time()
+    response = await session.get(b'http://hedgetest/')
+    assert_equal(response.status_code, 200)
+    assert time.time() - start < 0.5
+
+    assert_equal(session.hedge_stats(), {
+        'requests': 1, 'hedged': 1, 'hedge_wins': 1, 'hedge_losses': 0, 'win_rate': 1.0
+    })
+
+    # The attempt that lost was closed and released once it is cancelled.
+    await asyncio.sleep(0.01, loop=loop)
+
+    pool = list(session.hosts.values())[0]
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['addresses'][('127.0.0.1', port)], { 'connections': 1, 'outstanding': 0 })
+    assert not any(c.connected for c in pool.subpools[('127.0.0.1', port)].connections)
+
+    server.close()
+
+@start_loop
+async def test_session_hedge_rate(loop):
+    server, url = await start_stalled_server(loop)
+    port = server.sockets[0].getsockname()[1]
+    session = hedged_session(loop, port, hedge_delay=0.05, hedge_rate=0)
+
+    try:
+        await session.get(b'http://hedgetest/', timeout=0.2)
+        raise AssertionError('The request did not time out.')
+    except asyncio.TimeoutError:
+        pass
+
+    assert_equal(session.hedge_stats(), {
+        'requests': 1, 'hedged': 0, 'hedge_wins': 0, 'hedge_losses': 0, 'win_rate': 0
+    })
+
+    server.close()
+
+@start_loop
+async def test_session_hedge_percentile(loop):
+    session = uvhttp.http.Session(1, loop, hedge_delay=1, hedge_percentile=95)
+
+    for _ in range(20):
+        response = await session.get(b'http://127.0.0.1/')
+        assert_equal(response.status_code, 200)
+
+    pool = list(session.hosts.values())[0]
+    assert session.hedge_delay_for(pool) < 1
+
+    session.latencies[pool].extend([ i / 100 for i in range(100) ])
+    assert_equal(session.hedge_delay_for(pool), 0.95)
+
+    assert_equal(session.hedge_stats()['requests'], 20)
+
+class IdleClosingProtocol(asyncio.Protocol):
+    """
+    Answers one request and then closes the connection as if it had timed
+    out while idle, without a ``Connection: close`` header.
+    """
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(b'HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nhello\n')
+        self.transport.close()
+
+async def start_idle_closing_server(loop):
+    server = await loop.create_server(IdleClosingProtocol, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, 'http://127.0.0.1:{}/'.format(port).encode()
+
+@start_loop
+async def test_session_retries_stale_connections(loop):
+    server, url = await start_idle_closing_server(loop)
+    session = uvhttp.http.Session(1, loop)
+
+    for _ in range(3):
+        response = await session.get(url)
+        assert_equal(response.status_code, 200)
+        assert_equal(response.text, 'hello\n')
+
+        # Let the server close the idle connection.
+        await asyncio.sleep(0.01)
+
+    pool = list(session.hosts.values())[0]
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['retries'], 2)
+    assert_equal(stats['stale_connections'], 2)
+    assert not pool.pool_available.locked()
+
+    server.close()
+
+@start_loop
+async def test_session_stale_connection_not_retried(loop):
+    server, url = await start_idle_closing_server(loop)
+
+    for kwargs in [ {}, { 'retries': 0 } ]:
+        session = uvhttp.http.Session(1, loop, **kwargs)
+        method = b'POST' if not kwargs else b'GET'
+
+        response = await session.request(method, url, data=b'hello')
+        assert_equal(response.status_code, 200)
+        await asyncio.sleep(0.01)
+
+        try:
+            await session.request(method, url, data=b'hello')
+            raise AssertionError('The request was retried.')
+        except uvhttp.http.StaleConnectionError:
+            pass
+
+        pool = list(session.hosts.values())[0]
+        stats = await pool.stats(detailed=True)
+        assert_equal(stats['retries_exhausted'], 1)
+        assert not pool.pool_available.locked()
+
+        # The closed connection is not reused.
+        response = await session.request(method, url, data=b'hello')
+        assert_equal(response.status_code, 200)
+
+    server.close()
+
+@start_loop
+async def test_session_protocol(loop):
+    session = uvhttp.http.Session(1, loop, protocol=True)
+
+    for _ in range(5):
+        response = await session.request(b'HEAD', b'http://127.0.0.1/')
+        assert response.status_code == 200
+
+        response = await session.request(b'GET', b'http://127.0.0.1/lol')
+        assert response.status_code == 404
+        assert b'<head><title>404 Not Found</title></head>' in response.content
+
+        response = await session.request(b'GET', b'http://127.0.0.2/', headers={
+            b'Host': b'imgur.com'
+        })
+        assert response.status_code == 200
+        assert len(response.content) > 100000
+
+        response = await session.request(b'GET', b'http://127.0.0.2/', headers={
+            b'Host': b'imgur.com'
+        }, stream=True)
+
+        content = b''
+        async for chunk in response.iter_chunks():
+            content += chunk
+
+        assert len(content) > 100000
+
+    assert await session.connections() == 2
+
+@start_loop
+async def test_session_protocol_low_keepalives(loop):
+    session = uvhttp.http.Session(1, loop, protocol=True)
+
+    for _ in range(6):
+        response = await session.request(b'HEAD', b'http://127.0.0.1/low_keepalive')
+        assert response.status_code == 200
+
+    connections = await session.connections()
+    assert_equal(connections, 3)
+
+@start_loop
+async def test_session_retries_on_fresh_connection(loop):
+    server, url = await start_idle_closing_server(loop)
+    session = uvhttp.http.Session(3, loop, reuse='fifo')
+
+    responses = await asyncio.gather(*[ session.get(url) for _ in range(3) ], loop=loop)
+    for response in responses:
+        assert_equal(response.status_code, 200)
+
+    # Let the server close all three idle connections.
+    await asyncio.sleep(0.01)
+
+    response = await session.get(url)
+    assert_equal(response.status_code, 200)
+    assert_equal(response.text, 'hello\n')
+
+    # The retry reconnected rather than trying the next stale socket.
+    pool = list(session.hosts.values())[0]
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['stale_connections'], 1)
+    assert_equal(stats['retries'], 1)
+    assert_equal(stats.get('retries_exhausted', 0), 0)
+
+    server.close()
+
+@start_loop
+async def test_session_pipeline(loop):
+    session = uvhttp.http.Session(2, loop, pipeline=4)
+
+    async def do_request(path, method=b'GET'):
+        response = await session.request(method, b'http://127.0.0.1' + path)
+        assert response.status_code == 200
+        return response
+
+    responses = await asyncio.gather(*[ do_request(b'/test.json') for _ in range(40) ], loop=loop)
+    for response in responses:
+        assert_equal(response.json(), [{"this is a json": "Body!"}])
+
+    responses = await asyncio.gather(
+        do_request(b'/test.json'),
+        do_request(b'/', method=b'HEAD'),
+        do_request(b'/proxy/echo', method=b'POST'),
+        do_request(b'/test.json'),
+        loop=loop
+    )
+    assert_equal(responses[0].json(), [{"this is a json": "Body!"}])
+    assert_equal(responses[3].json(), [{"this is a json": "Body!"}])
+
+    assert await session.connections() == 2
+
+@start_loop
+async def test_session_pipeline_replay(loop):
+    session = uvhttp.http.Session(1, loop, pipeline=4)
+
+    async def do_request():
+        response = await session.request(b'GET', b'http://127.0.0.1/low_keepalive')
+        assert response.status_code == 200
+        assert response.content == b'hello\n'
+
+    await asyncio.gather(*[ do_request() for _ in range(8) ], loop=loop)
+
+    # The server closes the connection after every two requests, so requests
+    # pipelined after those must have been replayed on new connections.
+    connections = await session.connections()
+    assert connections >= 4
+
+class SlowProtocol(asyncio.Protocol):
+    """
+    Answers each request 0.2 seconds after the previous answer, in order.
+    """
+    def connection_made(self, transport):
+        self.transport = transport
+        self.queued = 0
+
+    def data_received(self, data):
+        for _ in range(data.count(b'\r\n\r\n')):
+            self.queued += 1
+            asyncio.get_event_loop().call_later(0.2 * self.queued, self.respond)
+
+    def respond(self):
+        if not self.transport.is_closing():
+            self.transport.write(b'HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nhello\n')
+
+@start_loop
+async def test_session_pipeline_abort(loop):
+    server = await loop.create_server(SlowProtocol, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:{}/'.format(server.sockets[0].getsockname()[1]).encode()
+    session = uvhttp.http.Session(1, loop, pipeline=2)
+
+    async def do_timeout():
+        try:
+            await session.get(url, read_timeout=0.1)
+            raise AssertionError('The request did not time out.')
+        except asyncio.TimeoutError:
+            pass
+
+    for _ in range(5):
+        # The second request times out while the first is still at the head
+        # of the pipeline, its response must be discarded.
+        response, _ = await asyncio.gather(session.get(url), do_timeout(), loop=loop)
+        assert_equal(response.text, 'hello\n')
+
+    connection = list(session.hosts.values())[0].pool[0]
+    assert_equal(len(connection.pending), 0)
+    assert_equal(connection.outstanding, 0)
+
+    server.close()
+
+@start_loop
+async def test_session_warmup(loop):
+    session = uvhttp.http.Session(4, loop)
+
+    stats = await session.warmup(b'http://127.0.0.1/', connections=4)
+    assert_equal(stats['opened'], 4)
+    assert_equal(stats['open'], 0)
+    assert_equal(stats['failed'], 0)
+    assert stats['connect_max'] >= stats['connect_avg'] >= stats['connect_min']
+    assert stats['total'] >= stats['connect_max']
+
+    assert_equal(await session.connections(), 4)
+
+    for _ in range(8):
+        response = await session.request(b'HEAD', b'http://127.0.0.1/')
+        assert response.status_code == 200
+
+    assert_equal(await session.connections(), 4)
+
+    stats = await session.warmup(b'http://127.0.0.1/', connections=8)
+    assert_equal(stats['opened'], 0)
+    assert_equal(stats['open'], 4)
+
+@start_loop
+async def test_session_warmup_many(loop):
+    session = uvhttp.http.Session(4, loop)
+
+    urls = [ b'http://127.0.0.1/', b'http://127.0.0.2/', b'http://127.0.0.1:31337/' ]
+    stats = await session.warmup_many(urls, connections=2)
+
+    assert_equal(stats[urls[0]]['opened'], 2)
+    assert_equal(stats[urls[1]]['opened'], 2)
+    assert_equal(stats[urls[2]]['failed'], 2)
+
+    assert_equal(await session.connections(), 6)
+
 @start_loop
 async def test_session_no_keepalives(loop):
     session = uvhttp.http.Session(1, loop)
@@ -145,6 +850,23 @@ async def test_session_no_keepalives(loop):
     connections = await session.connections()
     assert_equal(connections, 6)
 
+@start_loop
+async def test_session_prefers_open_connections(loop):
+    session = uvhttp.http.Session(2, loop)
+
+    await asyncio.gather(*[ session.request(b'HEAD', b'http://127.0.0.1/')
+        for _ in range(2) ], loop=loop)
+    assert_equal(await session.connections(), 2)
+
+    # The closed connection is reused last, after the one still open.
+    response = await session.request(b'HEAD', b'http://127.0.0.1/no_keepalive')
+    assert response.status_code == 200
+
+    response = await session.request(b'HEAD', b'http://127.0.0.1/')
+    assert response.status_code == 200
+
+    assert_equal(await session.connections(), 2)
+
 @start_loop
 async def test_session_low_keepalives(loop):
     session = uvhttp.http.Session(1, loop)
@@ -181,6 +903,186 @@ async def test_session_benchmark(loop):
 
     assert await session.connections() == 10
 
+@start_loop
+async def test_session_url_cache(loop):
+    session = uvhttp.http.Session(1, loop, url_cache_size=2)
+
+    pool, host, path = session.lookup(b'http://127.0.0.1/a?b=c#d')
+    assert_equal((host, path), (b'127.0.0.1', b'/a?b=c'))
+    assert session.lookup(b'http://127.0.0.1/a?b=c#d') == (pool, host, path)
+
+    session.lookup(b'http://127.0.0.1/b')
+    session.lookup(b'http://127.0.0.1/c')
+    assert_equal(list(session.urls.keys()), [ b'http://127.0.0.1/b', b'http://127.0.0.1/c' ])
+
+    response = await session.get(b'http://127.0.0.1/c')
+    assert_equal(response.status_code, 200)
+    assert_equal(len(session.hosts), 1)
+
+    session.close()
+    assert not session.urls
+
+@start_loop
+async def test_session_origin_cache(loop):
+    session = uvhttp.http.Session(1, loop, url_cache='origin')
+
+    for url, path in [ (b'http://127.0.0.1/a?b=c#d', b'/a?b=c'), (b'http://127.0.0.1', b'/'),
+                       (b'http://127.0.0.1?q', b'/?q'), (b'http://127.0.0.1/x/y', b'/x/y') ]:
+        pool, host, lookup_path = session.lookup(url)
+        assert_equal((host, lookup_path), (b'127.0.0.1', path))
+
+    assert_equal(list(session.urls.keys()), [ b'http://127.0.0.1' ])
+
+    pool, host, path = session.lookup(b'http://127.0.0.1:8089/echo')
+    assert_equal(pool.port, 8089)
+    assert_equal(len(session.urls), 2)
+
+    response = await session.get(b'http://127.0.0.1/proxy/echo?q=1')
+    assert_equal(response.json()['url'], 'http://127.0.0.1/echo?q=1')
+
+class AsyncRequests:
+    """
+    An asynchronous iterable of requests.
+    """
+    def __init__(self, requests):
+        self.requests = iter(requests)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+
+        try:
+            return next(self.requests)
+        except StopIteration:
+            raise StopAsyncIteration
+
+@start_loop
+async def test_session_map(loop):
+    urls = [ b'http://127.0.0.1/proxy/echo?i=' + str(i).encode() for i in range(50) ]
+
+    for requests in [ urls, iter(urls), AsyncRequests(urls) ]:
+        session = uvhttp.http.Session(10, loop)
+
+        results = session.map(requests, concurrency=3)
+        seen = []
+
+        async for url, response in results:
+            assert_equal(response.json()['url'], url.decode().replace('/proxy', ''))
+            assert len(results.results) <= 6
+            seen.append(url)
+
+        assert_equal(sorted(seen), sorted(urls))
+        assert await session.connections() <= 3
+
+@start_loop
+async def test_session_map_ordered(loop):
+    session = uvhttp.http.Session(10, loop)
+    prepared = session.prepare(b'GET', b'http://127.0.0.1/proxy/echo?prepared')
+
+    requests = [ (b'POST', b'http://127.0.0.1/proxy/echo', None, str(i).encode())
+        for i in range(20) ] + [ prepared ]
+
+    results = []
+    async for request, response in session.map(requests, concurrency=4, ordered=True):
+        results.append((request, response.json()))
+
+    assert_equal([ request for request, response in results ], requests)
+    assert_equal([ response['body'] for request, response in results[:-1] ],
+        [ str(i) for i in range(20) ])
+    assert_equal(results[-1][1]['url'], 'http://127.0.0.1/echo?prepared')
+
+@start_loop
+async def test_session_map_errors(loop):
+    server, url = await start_stalled_server(loop)
+    session = uvhttp.http.Session(10, loop, read_timeout=0.05)
+
+    requests = [ b'http://127.0.0.1/', url, b'http://127.0.0.1/' ]
+
+    results = []
+    async for request, response in session.map(requests, ordered=True, return_exceptions=True):
+        results.append(response)
+
+    assert_equal(results[0].status_code, 200)
+    assert isinstance(results[1], asyncio.TimeoutError)
+    assert_equal(results[2].status_code, 200)
+
+    results = session.map([ url ] * 20, concurrency=2)
+    try:
+        async for request, response in results:
+            raise AssertionError('The request did not fail.')
+    except asyncio.TimeoutError:
+        pass
+
+    await asyncio.sleep(0)
+    assert all(worker.done() for worker in results.workers)
+
+    server.close()
+
+@start_loop
+async def test_prepared_request(loop):
+    session = uvhttp.http.Session(1, loop)
+
+    prepared = session.prepare(b'POST', b'http://127.0.0.1/proxy/echo?q=1', headers={
+        b'User-Agent': b'prepared'
+    })
+
+    for i in range(3):
+        data = str(i).encode()
+        response = await prepared.send(headers={ b'X-Attempt': data }, data=data)
+        response_json = response.json()
+
+        assert_equal(response_json['body'], str(i))
+        assert_equal(response_json['url'], 'http://127.0.0.1/echo?q=1')
+        assert_equal(response_json['headers']['user-agent'], 'prepared')
+        assert_equal(response_json['headers']['x-attempt'], str(i))
+        assert_equal(response_json['headers']['host'], '127.0.0.1')
+
+    assert prepared.pool is session.lookup(b'http://127.0.0.1/')[0]
+    assert_equal(await session.connections(), 1)
+
+@start_loop
+async def test_prepared_request_benchmark(loop):
+    num_requests = 2000
+    url = b'http://127.0.0.1/'
+    headers = { b'Accept': b'*/*', b'X-Client': b'benchmark' }
+
+    session = uvhttp.http.Session(1, loop)
+    prepared = session.prepare(b'HEAD', url, headers=headers)
+
+    # The work a request does before it is sent, with and without preparing.
+    def unprepared_head():
+        pool, host, path = session.lookup(url)
+        return uvhttp.http.serialize_head(b'HEAD', host, path, headers) + b'\r\n'
+
+    def prepared_head():
+        return prepared.head + b'\r\n'
+
+    assert_equal(unprepared_head(), prepared_head())
+
+    for name, func in [ ('request head', unprepared_head), ('prepared head', prepared_head) ]:
+        start_time = time.process_time()
+
+        for _ in range(num_requests * 10):
+            func()
+
+        duration = time.process_time() - start_time
+        print('{}: {:.2f}us of CPU per request'.format(name, duration / num_requests / 10 * 1e6))
+
+    async def unprepared():
+        return await session.request(b'HEAD', url, headers=headers)
+
+    for name, func in [ ('request', unprepared), ('prepared', prepared.send) ]:
+        start_time = time.process_time()
+
+        for _ in range(num_requests):
+            response = await func()
+            assert_equal(response.status_code, 200)
+
+        duration = time.process_time() - start_time
+        print('{}: {:.1f}us of CPU per request'.format(name, duration / num_requests * 1e6))
+
 @start_loop
 async def test_json_body(loop):
     session = uvhttp.http.Session(10, loop)
@@ -189,6 +1091,50 @@ async def test_json_body(loop):
 
     assert response.json() == [{"this is a json": "Body!"}]
 
+@start_loop
+async def test_json_loads(loop):
+    decoded = []
+
+    def loads(data):
+        decoded.append(data)
+        return json.loads(data)
+
+    session = uvhttp.http.Session(10, loop, json_loads=loads)
+
+    response = await session.request(b'GET', b'http://127.0.0.1/test.json')
+    assert_equal(response.json(), [{"this is a json": "Body!"}])
+    assert_equal(await response.json_async(), [{"this is a json": "Body!"}])
+
+    # The body was decoded from bytes, without a str copy.
+    assert_equal(decoded, [ response.content ] * 2)
+    assert isinstance(decoded[0], bytes)
+
+    assert_equal(uvhttp.http.decode_json(b'{"a": 1}'), { 'a': 1 })
+
+@start_loop
+async def test_json_offload(loop):
+    threads = []
+
+    def loads(data):
+        threads.append(threading.current_thread())
+        return json.loads(data)
+
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    session = uvhttp.http.Session(10, loop, json_loads=loads, json_offload_size=1024,
+        json_executor=executor)
+
+    response = await session.request(b'GET', b'http://127.0.0.1/test.json')
+    assert_equal(await response.json_async(), [{"this is a json": "Body!"}])
+    assert threads[-1] is threading.current_thread()
+
+    data = b'x' * 2048
+    response = await session.post(b'http://127.0.0.1/proxy/echo', data=data)
+    assert len(response.content) >= 1024
+    assert_equal((await response.json_async())['body'], data.decode())
+    assert threads[-1] is not threading.current_thread()
+
+    executor.shutdown()
+
 @start_loop
 async def test_text_request_body(loop):
     session = uvhttp.http.Session(10, loop)
@@ -1,6 +1,10 @@
+import uvhttp.dns
 import uvhttp.pool
+from nose.tools import *
 import asyncio
+import collections
 import functools
+import socket
 import ssl
 import time
 
@@ -86,6 +90,29 @@ async def test_connection_reuse(loop):
 
     assert conn.connect_count == 1
 
+@start_loop
+async def test_protocol_connection_reuse(loop):
+    pool_available = asyncio.Semaphore(1, loop=loop)
+
+    conn = uvhttp.pool.ProtocolConnection('127.0.0.1', 80, pool_available, loop)
+    conn.locked = True
+
+    await conn.send(HEAD)
+    response = await conn.read(65535)
+    assert response[:len(STATUS_200)] == STATUS_200
+
+    conn.release()
+    conn.locked = True
+
+    await conn.send(GET_404)
+    response = await conn.read(65535)
+    assert response[:len(STATUS_404)] == STATUS_404
+
+    conn.close()
+    conn.release()
+
+    assert conn.connect_count == 1
+
 @start_loop
 async def test_connection_eof(loop):
     pool_available = asyncio.Semaphore(1, loop=loop)
@@ -204,6 +231,229 @@ async def test_pool_blocks_when_full(loop):
 
     assert await pool.stats() == 2
 
+@start_loop
+async def test_pool_reuse_lifo(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 3, loop)
+
+    conns = [ await pool.connect() for _ in range(3) ]
+    for conn in conns:
+        await conn.connect()
+        conn.release()
+
+    assert_equal(list(pool.idle), conns)
+
+    # The most recently released connection is reused first.
+    conn = await pool.connect()
+    assert conn is conns[2]
+    assert conn.locked
+    conn.release()
+
+    # Closed idle connections are reused last.
+    conns[2].close()
+    assert_equal(list(pool.idle), [ conns[2], conns[0], conns[1] ])
+
+    conn = await pool.connect()
+    assert conn is conns[1]
+    conn.release()
+
+    # So are connections that were closed while in use.
+    conn = await pool.connect()
+    conn.close()
+    conn.release()
+    assert_equal(list(pool.idle), [ conns[1], conns[2], conns[0] ])
+
+    pool.close()
+
+@start_loop
+async def test_pool_reuse_fifo(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 3, loop, reuse='fifo')
+
+    conns = [ await pool.connect() for _ in range(3) ]
+    for conn in conns:
+        conn.release()
+
+    # The least recently released connection is reused first.
+    conn = await pool.connect()
+    assert conn is conns[0]
+    conn.release()
+
+    conn = await pool.connect()
+    assert conn is conns[1]
+    conn.release()
+
+    # Closed idle connections are reused last.
+    conns[2].close()
+    assert_equal(list(pool.idle), [ conns[0], conns[1], conns[2] ])
+
+    # Connections are only opened once no idle connections are left.
+    assert_equal(len(pool.pool), 3)
+
+@start_loop
+async def test_pool_reuses_idle_connections(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 10, loop)
+
+    for _ in range(5):
+        conn = await pool.connect()
+
+        await conn.send(HEAD)
+        response = await conn.read(65535)
+        assert response[:len(STATUS_200)] == STATUS_200
+
+        conn.release()
+
+    assert_equal(len(pool.pool), 1)
+    assert await pool.stats() == 1
+
+async def queue_connects(loop, pool, priorities, order):
+    """
+    Queue a connect() for each of ``priorities``, which append their priority
+    to ``order`` once they get a connection.
+    """
+    async def connect(priority):
+        conn = await pool.connect(priority)
+        order.append(priority)
+        await asyncio.sleep(0.01, loop=loop)
+        conn.release()
+
+    tasks = []
+    for priority in priorities:
+        tasks.append(asyncio.ensure_future(connect(priority), loop=loop))
+        await asyncio.sleep(0, loop=loop)
+
+    return tasks
+
+@start_loop
+async def test_pool_priority(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 1, loop)
+
+    order = []
+
+    conn = await pool.connect()
+    tasks = await queue_connects(loop, pool, [5, 5, 5, 0, 1], order)
+    conn.release()
+
+    await asyncio.gather(*tasks, loop=loop)
+    assert_equal(order, [0, 1, 5, 5, 5])
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['priorities'][5]['served'], 3)
+    assert_equal(stats['priorities'][5]['waiting'], 0)
+    assert stats['priorities'][5]['wait_max'] >= stats['priorities'][0]['wait_max']
+    assert stats['priorities'][5]['wait_avg'] > 0
+
+@start_loop
+async def test_pool_priority_aging(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 1, loop, priority_aging=0.05)
+
+    order = []
+
+    conn = await pool.connect()
+    tasks = await queue_connects(loop, pool, [2], order)
+
+    # Waiting 0.2 seconds makes the priority 2 waiter more urgent than 0.
+    await asyncio.sleep(0.2, loop=loop)
+    tasks += await queue_connects(loop, pool, [0], order)
+    conn.release()
+
+    await asyncio.gather(*tasks, loop=loop)
+    assert_equal(order, [2, 0])
+
+@start_loop
+async def test_priority_semaphore_cancel(loop):
+    semaphore = uvhttp.pool.PrioritySemaphore(1, loop)
+    await semaphore.acquire()
+
+    waiter = asyncio.ensure_future(semaphore.acquire(3), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+    assert_equal(semaphore.stats()[3]['waiting'], 1)
+
+    waiter.cancel()
+    await asyncio.sleep(0, loop=loop)
+    assert_equal(semaphore.stats()[3]['waiting'], 0)
+
+    semaphore.release()
+    assert not semaphore.locked()
+
+async def head(pool):
+    conn = await pool.connect()
+
+    await conn.send(HEAD)
+    response = await conn.read(65535)
+    assert response[:len(STATUS_200)] == STATUS_200
+
+    conn.release()
+    return conn
+
+@start_loop
+async def test_pool_max_requests(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 1, loop, max_requests=2)
+
+    for _ in range(5):
+        await head(pool)
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['connects'], 3)
+    assert_equal(stats['reaped'], 2)
+    assert_equal(stats['reaped_max_requests'], 2)
+
+@start_loop
+async def test_pool_max_lifetime(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 1, loop, max_lifetime=0.2)
+
+    conn = await head(pool)
+    await asyncio.sleep(0.05)
+    await head(pool)
+    assert conn.connected
+
+    await asyncio.sleep(0.2)
+    await head(pool)
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['connects'], 2)
+    assert_equal(stats['reaped_max_lifetime'], 1)
+
+    pool.close()
+
+@start_loop
+async def test_pool_idle_timeout(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 2, loop, idle_timeout=0.2)
+
+    conn = await head(pool)
+    assert conn.connected
+
+    await asyncio.sleep(0.5)
+    assert not conn.connected
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['reaped_idle_timeout'], 1)
+
+    # Nothing is left to reap, so the reaper stopped until the next connect.
+    assert pool.reaper is None
+
+    await head(pool)
+    assert_equal(await pool.stats(), 2)
+    assert pool.reaper is not None
+
+    pool.close()
+
+@start_loop
+async def test_pool_idle_timeout_replace(loop):
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 2, loop, idle_timeout=0.2, replace_reaped=True)
+
+    conn = await head(pool)
+
+    await asyncio.sleep(0.4)
+    assert conn.connected
+    assert not conn.locked
+
+    stats = await pool.stats(detailed=True)
+    assert stats['reaped_idle_timeout'] >= 1
+    assert stats['replaced'] >= 1
+
+    assert await head(pool) is conn
+
+    pool.close()
+
 @start_loop
 async def test_pool_benchmark(loop):
     num_requests = 20000
@@ -233,6 +483,35 @@ async def test_pool_benchmark(loop):
 
     assert await pool.stats() == 10
 
+@start_loop
+async def test_protocol_pool_benchmark(loop):
+    num_requests = 20000
+
+    async def do_request(pool):
+        conn = await pool.connect()
+
+        await conn.send(HEAD)
+        response = await conn.read(65535)
+        assert response[:len(STATUS_200)] == STATUS_200
+
+        conn.release()
+
+    pool = uvhttp.pool.Pool('127.0.0.1', 80, 10, loop, protocol=True)
+    start_time = time.time()
+
+    tasks = []
+    for j in range(num_requests):
+        task = do_request(pool)
+        task = asyncio.ensure_future(task)
+        tasks.append(task)
+
+    await asyncio.wait(tasks)
+
+    duration = time.time() - start_time
+    print('Test time: {}s, {} rps'.format(duration, num_requests / duration))
+
+    assert await pool.stats() == 10
+
 @start_loop
 async def test_pool_with_ssl(loop):
     ssl_ctx = ssl.create_default_context()
@@ -253,6 +532,227 @@ async def test_pool_with_ssl(loop):
 
     conn.release()
 
+@start_loop
+async def test_pool_tls_session_resumption(loop):
+    if not uvhttp.pool.TLS_SESSIONS:
+        return
+
+    ssl_ctx = ssl.create_default_context()
+    ssl_ctx.check_hostname = False
+    ssl_ctx.verify_mode = ssl.CERT_NONE
+
+    pool = uvhttp.pool.Pool('127.0.0.1', 443, 2, loop, ssl=ssl_ctx)
+
+    for _ in range(3):
+        conn = await pool.connect()
+
+        await conn.send(HEAD)
+        response = await conn.read(65535)
+        assert response[:len(STATUS_200)] == STATUS_200
+
+        conn.close()
+        conn.release()
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['connects'], 3)
+    assert_equal(stats['tls_full_handshakes'], 1)
+    assert_equal(stats['tls_resumed'], 2)
+
+@start_loop
+async def test_pool_happy_eyeballs_failover(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.add_to_cache('racetest', 80, '127.0.0.1', 40, port=31337)
+    resolver.add_to_cache('racetest', 80, '127.0.0.2', 40, port=80, overwrite=False)
+
+    pool = uvhttp.pool.Pool('racetest', 80, 1, loop, resolver=resolver)
+
+    conn = await head(pool)
+    assert_equal((conn.host, conn.port), ('127.0.0.2', 80))
+
+    # The address that worked is tried first next time.
+    conn.close()
+    await head(pool)
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['connects'], 2)
+    assert_equal(stats['connect_failed'], 1)
+    assert_equal(stats['connected_ipv4'], 2)
+
+@start_loop
+async def test_pool_happy_eyeballs_delay(loop):
+    # A listener whose backlog is full never completes new connections.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+
+    queued = socket.socket()
+    queued.connect(listener.getsockname())
+
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.add_to_cache('racetest', 80, '127.0.0.1', 40, port=listener.getsockname()[1])
+    resolver.add_to_cache('racetest', 80, '127.0.0.1', 40, port=80, overwrite=False)
+
+    pool = uvhttp.pool.Pool('racetest', 80, 1, loop, resolver=resolver,
+                            happy_eyeballs_delay=0.05)
+
+    start = time.time()
+    conn = await head(pool)
+    assert time.time() - start < 1
+    assert_equal(conn.port, 80)
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['connect_raced'], 1)
+
+    pool.close()
+    queued.close()
+    listener.close()
+
+def balanced_pool(loop, ips, conn_limit, **kwargs):
+    resolver = uvhttp.dns.Resolver(loop)
+    set_addresses(resolver, ips)
+
+    return uvhttp.pool.Pool('balancetest', 80, conn_limit, loop, resolver=resolver, **kwargs)
+
+def set_addresses(resolver, ips):
+    for i, ip in enumerate(ips):
+        resolver.add_to_cache('balancetest', 80, ip, 40, port=80, overwrite=i == 0)
+
+@start_loop
+async def test_pool_balance_least_outstanding(loop):
+    pool = balanced_pool(loop, ['127.0.0.1', '127.0.0.2', '127.0.0.3'], 6,
+                         balance='least_outstanding')
+
+    conns = [ await pool.connect() for _ in range(6) ]
+    hosts = collections.Counter(conn.host for conn in conns)
+    assert_equal(hosts, { '127.0.0.1': 2, '127.0.0.2': 2, '127.0.0.3': 2 })
+
+    for conn in conns:
+        await conn.send(HEAD)
+        response = await conn.read(65535)
+        assert response.startswith(b'HTTP/1.1 ')
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['addresses'][('127.0.0.1', 80)], { 'connections': 2, 'outstanding': 2 })
+
+    for conn in conns:
+        conn.release()
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['addresses'][('127.0.0.1', 80)], { 'connections': 2, 'outstanding': 0 })
+
+    pool.close()
+
+@start_loop
+async def test_pool_balance_power_of_two(loop):
+    pool = balanced_pool(loop, ['127.0.0.1', '127.0.0.2', '127.0.0.3'], 30,
+                         balance='power_of_two')
+
+    conns = [ await pool.connect() for _ in range(30) ]
+    hosts = collections.Counter(conn.host for conn in conns)
+    assert_equal(len(hosts), 3)
+    assert max(hosts.values()) - min(hosts.values()) <= 3
+
+    for conn in conns:
+        conn.release()
+
+@start_loop
+async def test_pool_balance_drains_removed_addresses(loop):
+    pool = balanced_pool(loop, ['127.0.0.1', '127.0.0.2', '127.0.0.3'], 4,
+                         balance='least_outstanding')
+
+    conns = [ await pool.connect() for _ in range(3) ]
+    for conn in conns:
+        conn.release()
+
+    # 127.0.0.2 is in use when it drops out, 127.0.0.3 is idle.
+    first = await pool.connect()
+    second = await pool.connect()
+    assert_equal((first.host, second.host), ('127.0.0.1', '127.0.0.2'))
+
+    set_addresses(pool.resolver, ['127.0.0.1'])
+
+    conn = await head(pool)
+    assert_equal(conn.host, '127.0.0.1')
+    assert_equal(len(pool.pool), 3)
+
+    second.release()
+    assert_equal(len(pool.pool), 2)
+    assert_equal(list(pool.subpools), [('127.0.0.1', 80)])
+
+    first.release()
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['retired'], 2)
+    assert_equal(stats['drained_addresses'], 2)
+
+    pool.close()
+
+@start_loop
+async def test_pool_balance_moves_idle_connections(loop):
+    pool = balanced_pool(loop, ['127.0.0.1'], 2, balance='least_outstanding')
+
+    conns = [ await pool.connect() for _ in range(2) ]
+    for conn in conns:
+        conn.release()
+
+    set_addresses(pool.resolver, ['127.0.0.1', '127.0.0.2'])
+
+    first = await pool.connect()
+    second = await pool.connect()
+    assert_equal((first.host, second.host), ('127.0.0.1', '127.0.0.2'))
+
+    await second.send(HEAD)
+    response = await second.read(65535)
+    assert response[:len(STATUS_200)] == STATUS_200
+
+    first.release()
+    second.release()
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['rebalanced'], 1)
+
+    pool.close()
+
+@start_loop
+async def test_pool_balance_avoids_failed_addresses(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.add_to_cache('balancetest', 80, '127.0.0.1', 40, port=31337)
+    resolver.add_to_cache('balancetest', 80, '127.0.0.2', 40, port=80, overwrite=False)
+
+    pool = uvhttp.pool.Pool('balancetest', 80, 2, loop, resolver=resolver,
+                            balance='least_outstanding')
+
+    conn = await pool.connect()
+    assert_equal(conn.port, 31337)
+    try:
+        await conn.send(HEAD)
+        raise AssertionError("ConnectionRefusedError was not raised.")
+    except ConnectionRefusedError:
+        pass
+
+    conn.release()
+
+    for _ in range(3):
+        conn = await head(pool)
+        assert_equal(conn.host, '127.0.0.2')
+
+    stats = await pool.stats(detailed=True)
+    assert_equal(stats['connect_failed'], 1)
+
+@start_loop
+async def test_pool_without_happy_eyeballs(loop):
+    resolver = uvhttp.dns.Resolver(loop)
+    resolver.add_to_cache('racetest', 80, '127.0.0.2', 40, port=80)
+
+    pool = uvhttp.pool.Pool('racetest', 80, 1, loop, resolver=resolver,
+                            happy_eyeballs_delay=None)
+
+    conn = await head(pool)
+    assert_equal(conn.host, '127.0.0.2')
+
+    stats = await pool.stats(detailed=True)
+    assert 'connected_ipv4' not in stats
+
 @start_loop
 async def test_pool_with_ssl_verification(loop):
     ssl_ctx = ssl.create_default_context()
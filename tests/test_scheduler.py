@@ -0,0 +1,99 @@
+from uvhttp.scheduler import FairScheduler
+from uvhttp.utils import start_loop
+from nose.tools import *
+import asyncio
+
+@start_loop
+async def test_scheduler_limit(loop):
+    scheduler = FairScheduler(2, loop)
+
+    await scheduler.acquire('a')
+    await scheduler.acquire('a')
+
+    waiter = asyncio.ensure_future(scheduler.acquire('a'), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+    assert not waiter.done()
+
+    scheduler.release()
+    await waiter
+
+    stats = scheduler.stats()
+    assert_equal(stats['active'], 2)
+    assert_equal(stats['waiting'], 0)
+    assert_equal(stats['queued'], 1)
+
+@start_loop
+async def test_scheduler_round_robin(loop):
+    scheduler = FairScheduler(1, loop)
+    await scheduler.acquire('slow')
+
+    order = []
+
+    async def request(key):
+        await scheduler.acquire(key)
+        order.append(key)
+        scheduler.release()
+
+    tasks = [ request('slow') for _ in range(4) ] + [ request('fast') for _ in range(2) ]
+    tasks = [ asyncio.ensure_future(task, loop=loop) for task in tasks ]
+    await asyncio.sleep(0, loop=loop)
+
+    scheduler.release()
+    await asyncio.gather(*tasks, loop=loop)
+
+    assert_equal(order, ['slow', 'fast', 'slow', 'fast', 'slow', 'slow'])
+    assert_equal(scheduler.stats()['active'], 0)
+
+@start_loop
+async def test_scheduler_cancelled_waiter(loop):
+    scheduler = FairScheduler(1, loop)
+    await scheduler.acquire('a')
+
+    waiter = asyncio.ensure_future(scheduler.acquire('b'), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+
+    # Release before the cancelled acquire() gets to remove its waiter.
+    waiter.cancel()
+    scheduler.release()
+    assert_equal(scheduler.stats()['active'], 0)
+    assert_equal(scheduler.stats()['waiting'], 0)
+
+    await asyncio.sleep(0, loop=loop)
+    assert waiter.cancelled()
+    assert_equal(scheduler.stats()['active'], 0)
+    assert_equal(scheduler.stats()['waiting'], 0)
+
+    await scheduler.acquire('c')
+    assert_equal(scheduler.stats()['active'], 1)
+
+class FakeConnection:
+    def __init__(self):
+        self.connected = True
+        self.idle = True
+
+    def close(self):
+        self.connected = False
+
+@start_loop
+async def test_scheduler_trim_skips_closed_idle(loop):
+    scheduler = FairScheduler(2, loop)
+    connections = [ FakeConnection() for _ in range(2) ]
+
+    for connection in connections:
+        await scheduler.acquire('a')
+        scheduler.release(connection)
+
+    # The most recently used connection is closed by the server.
+    connections[1].connected = False
+
+    # A request that has to open a new socket makes room for it.
+    connection = FakeConnection()
+    connection.connected = False
+
+    await scheduler.acquire('a')
+    scheduler.reserve(connection)
+
+    # One request and one open idle socket are within the limit.
+    assert connections[0].connected
+    assert_equal(scheduler.stats()['idle'], 1)
+    assert_equal(scheduler.stats().get('closed_idle', 0), 0)
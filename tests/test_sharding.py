@@ -0,0 +1,58 @@
+from nose.tools import *
+import uvhttp.sharding
+
+def test_shard_by_origin():
+    client = uvhttp.sharding.ShardedClient(workers=4)
+
+    shard = client.shard(b'http://127.0.0.1/a')
+    assert_equal(client.shard(b'http://127.0.0.1/b?c'), shard)
+    assert_equal(client.shard((b'POST', b'http://127.0.0.1/d')), shard)
+
+    shards = set(client.shard('http://{}/'.format(i).encode()) for i in range(100))
+    assert_equal(shards, set(range(4)))
+
+def test_sharded_client():
+    client = uvhttp.sharding.ShardedClient(conn_limit=2, workers=2, concurrency=4,
+        batch_size=10)
+
+    urls = [ b'http://127.0.0.1/?' + str(i).encode() for i in range(100) ] + \
+           [ b'http://127.0.0.1:8089/?' + str(i).encode() for i in range(100) ]
+
+    results = dict(client.run(iter(urls)))
+    assert_equal(sorted(results.keys()), sorted(urls))
+    assert_equal(set(results.values()), set([ 200 ]))
+
+    stats = client.stats()
+    assert_equal(stats['requests'], 200)
+    assert_equal(stats.get('errors', 0), 0)
+    assert stats['rps'] > 0
+    assert stats['latency']['p50'] <= stats['latency']['p99'] <= stats['latency']['max']
+
+    # Each origin is only connected to from one worker.
+    assert stats['pools']['connects'] <= 4
+
+def body_length(response):
+    if response.status_code != 200:
+        raise ValueError(response.status_code)
+
+    return len(response.content)
+
+def test_sharded_client_handler_and_errors():
+    client = uvhttp.sharding.ShardedClient(workers=2, shard_by=None, batch_size=5,
+        handler=body_length, read_timeout=1)
+
+    requests = [ (b'GET', b'http://127.0.0.1/test.json') ] * 20 + \
+        [ b'http://127.0.0.1:1/', b'http://127.0.0.1/lol' ]
+
+    results = list(client.run(requests))
+    assert_equal(len(results), 22)
+
+    lengths = [ result for request, result in results if not isinstance(result, Exception) ]
+    assert_equal(lengths, [ 30 ] * 20)
+
+    errors = set(type(result) for request, result in results if isinstance(result, Exception))
+    assert_equal(errors, set([ ConnectionRefusedError, ValueError ]))
+
+    stats = client.stats()
+    assert_equal(stats['requests'], 22)
+    assert_equal(stats['errors'], 2)
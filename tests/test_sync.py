@@ -0,0 +1,61 @@
+from nose.tools import *
+import threading
+import uvhttp.sync
+
+def test_sync_client():
+    client = uvhttp.sync.Client(1)
+
+    for _ in range(3):
+        response = client.get(b'http://127.0.0.1/')
+        assert_equal(response.status_code, 200)
+        assert_equal(response.text, 'hello\n')
+
+    response = client.post(b'http://127.0.0.1/proxy/echo', data=b'hello')
+    assert_equal(response.json()['body'], 'hello')
+
+    # The connection was kept alive between calls.
+    assert_equal(client.call(client.session.connections()), 1)
+
+    client.close()
+    assert not client.thread.is_alive()
+
+def test_sync_client_errors():
+    with uvhttp.sync.Client(1, read_timeout=1) as client:
+        assert_raises(ConnectionRefusedError, client.get, b'http://127.0.0.1:1/')
+
+        response = client.head(b'http://127.0.0.1/')
+        assert_equal(response.status_code, 200)
+
+def test_sync_client_threads():
+    responses = []
+
+    with uvhttp.sync.Client(4) as client:
+        def get():
+            for _ in range(10):
+                responses.append(client.get(b'http://127.0.0.1/').status_code)
+
+        threads = [ threading.Thread(target=get) for _ in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert client.call(client.session.connections()) <= 4
+
+    assert_equal(responses, [ 200 ] * 40)
+
+def test_sync_client_map():
+    urls = [ b'http://127.0.0.1/proxy/echo?i=' + str(i).encode() for i in range(20) ]
+
+    with uvhttp.sync.Client(10) as client:
+        results = list(client.map(urls, concurrency=4, ordered=True))
+
+        assert_equal([ url for url, response in results ], urls)
+        assert_equal([ response.json()['url'] for url, response in results ],
+            [ url.decode().replace('/proxy', '') for url in urls ])
+
+        # Stopping early cancels the rest.
+        for url, response in client.map(urls, concurrency=2):
+            break
+
+        assert_equal(client.get(b'http://127.0.0.1/').status_code, 200)
@@ -8,6 +8,56 @@ def test_is_ip():
     assert_equal(uvhttp.utils.is_ip('example'), False)
     assert_equal(uvhttp.utils.is_ip('256.0.0.0'), False)
 
+def test_header_dict():
+    headers = uvhttp.utils.HeaderDict([
+        (b'Content-Type', b'text/html'),
+        (b'Set-Cookie', b'a=1'),
+        (b'set-cookie', b'b=2'),
+    ])
+
+    assert_equal(headers[b'content-type'], b'text/html')
+    assert_equal(headers[b'CONTENT-TYPE'], b'text/html')
+    assert_equal(headers[b'Set-Cookie'], b'b=2')
+    assert_equal(headers[b'missing'], b'')
+    assert_equal(headers.get(b'missing'), None)
+    assert_equal(headers.get(b'missing', b'default'), b'default')
+
+    assert_equal(headers.getall(b'SET-COOKIE'), [ b'a=1', b'b=2' ])
+    assert_equal(headers.getall(b'missing'), [])
+
+    assert b'set-cookie' in headers
+    assert b'missing' not in headers
+    assert_equal(len(headers), 3)
+
+    assert_equal(list(headers), [ b'Content-Type', b'Set-Cookie', b'set-cookie' ])
+    assert_equal(headers.keys(), [ b'Content-Type', b'Set-Cookie', b'set-cookie' ])
+    assert_equal(headers.values(), [ b'text/html', b'a=1', b'b=2' ])
+    assert_equal(headers.items(), [
+        (b'Content-Type', b'text/html'),
+        (b'Set-Cookie', b'a=1'),
+        (b'set-cookie', b'b=2'),
+    ])
+
+def test_header_dict_from_dict():
+    headers = uvhttp.utils.HeaderDict({ 'Host': 'example', 'Accept': '*/*' })
+
+    assert_equal(headers['host'], 'example')
+    assert_equal(headers['missing'], b'')
+    assert_equal(sorted(headers.items()), [ ('Accept', '*/*'), ('Host', 'example') ])
+
+    assert_equal(len(uvhttp.utils.HeaderDict()), 0)
+
+def test_header_dict_sees_new_pairs():
+    pairs = [ (b'Content-Length', b'5') ]
+    headers = uvhttp.utils.HeaderDict(pairs)
+
+    assert_equal(headers[b'content-length'], b'5')
+    assert_equal(headers[b'connection'], b'')
+
+    pairs.append((b'Connection', b'close'))
+    assert_equal(headers[b'connection'], b'close')
+    assert_equal(headers.getall(b'content-length'), [ b'5' ])
+
 @uvhttp.utils.start_loop
 @uvhttp.utils.http_server_no_loop(uvhttp.utils.HttpServer)
 async def test_test_server_no_loop(server, loop):
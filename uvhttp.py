@@ -1,35 +1,39 @@
 #!/usr/bin/env python3
-import asyncio
-import time
+import os
 
-from uvhttp.utils import start_loop, run_workers, NUM_WORKERS
-import uvhttp.http
+from uvhttp.utils import NUM_WORKERS
+import uvhttp.sharding
 
 NUM_REQUESTS = 100000
 
-@start_loop
-async def main(loop):
-    async def request(session):
-        response = await session.request(b'HEAD', b'http://127.0.0.1/', headers={
-            b'User-Agent': b'fast-af'
-        })
+# Set UVHTTP_PROTOCOL=1 to benchmark protocol based connections.
+USE_PROTOCOL = os.getenv("UVHTTP_PROTOCOL") == "1"
 
-    num_requests = int(NUM_REQUESTS / NUM_WORKERS)
-    session = uvhttp.http.Session(10, loop)
-    tasks = []
+# Set UVHTTP_PIPELINE to the number of requests to pipeline per connection.
+# HEAD requests are never pipelined, so GET requests are used instead.
+PIPELINE = int(os.getenv("UVHTTP_PIPELINE", 1))
+METHOD = b'GET' if PIPELINE > 1 else b'HEAD'
 
-    for j in range(num_requests):
-        task = request(session)
-        task = asyncio.ensure_future(task)
-        tasks.append(task)
+# Number of requests each worker keeps in flight.
+CONCURRENCY = int(os.getenv("UVHTTP_CONCURRENCY", 100))
 
-    await asyncio.wait(tasks)
+def main():
+    client = uvhttp.sharding.ShardedClient(conn_limit=10, workers=NUM_WORKERS,
+        concurrency=CONCURRENCY, shard_by=None, protocol=USE_PROTOCOL, pipeline=PIPELINE)
 
-    connect_count = await session.connections()
-    print('Requests per connection: {}'.format(num_requests / connect_count))
+    request = (METHOD, b'http://127.0.0.1/', {
+        b'User-Agent': b'fast-af'
+    })
+
+    for sent, status_code in client.run(request for _ in range(NUM_REQUESTS)):
+        pass
+
+    stats = client.stats()
+    print('Requests per connection: {}'.format(stats['requests'] / stats['pools']['connects']))
+    print('Latency: {}'.format(', '.join('{} {:.2f}ms'.format(name, latency * 1000)
+        for name, latency in sorted(stats['latency'].items()))))
+    print('%s HTTP requests in %.2f seconds, %.2f rps' % (stats['requests'], stats['duration'],
+        stats['rps']))
 
 if __name__ == '__main__':
-    start = time.time()
-    run_workers(main)
-    total = time.time() - start
-    print('%s HTTP requests in %.2f seconds, %.2f rps' % (NUM_REQUESTS, total, NUM_REQUESTS / total))
+    main()
@@ -0,0 +1,59 @@
+class ResponseBuffer:
+    """
+    Collects the chunks of a response body without repeatedly copying them.
+
+    The chunks are kept in a list and only joined into a single :class:`bytes`
+    object when :meth:`.getvalue` is called.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+
+        self.__value = None
+
+    def append(self, data):
+        """
+        Add a chunk of data to the end of the buffer.
+        """
+        size = len(data)
+        if not size:
+            return
+
+        self.chunks.append(data)
+        self.length += size
+        self.__value = None
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def memoryview(self):
+        """
+        Return a :class:`memoryview` of the body. This does not copy the body
+        if it arrived in a single chunk.
+        """
+        if len(self.chunks) == 1:
+            return memoryview(self.chunks[0])
+
+        return memoryview(self.getvalue())
+
+    def getvalue(self):
+        """
+        Return the body as a single :class:`bytes` object. The result is cached
+        until more data is appended.
+        """
+        if self.__value is not None:
+            return self.__value
+
+        if len(self.chunks) == 1:
+            self.__value = self.chunks[0]
+        else:
+            self.__value = b''.join(self.chunks)
+
+            # Keep the joined copy only, there is no need to hold both.
+            if self.chunks:
+                self.chunks = [ self.__value ]
+
+        return self.__value
@@ -1,26 +1,72 @@
 import aiodns
 import asyncio
+import collections
+import heapq
+import itertools
 import random
 import socket
 import time
 import uvhttp.utils
 
+# Expiry time of cache entries that never expire.
+FOREVER = 9999999999999
+
+# Errors that mean the host has no addresses, which are cached.
+NEGATIVE_ERRORS = (aiodns.error.ARES_ENOTFOUND, aiodns.error.ARES_ENODATA)
+
 class DNSError(Exception):
     pass
 
 class Resolver:
     """
     Caching DNS resolver wrapper for aiodns.
+
+    Up to ``cache_size`` address pairs are cached, evicting the least recently
+    used. Answers are cached for their TTL, and lookups that find no
+    addresses (NXDOMAIN or an empty answer) are cached for ``negative_ttl``
+    seconds.
+
+    An answer that expired less than ``stale_ttl`` seconds ago is still used
+    while it is refreshed in the background, and answers used within
+    ``refresh_ahead`` seconds of expiring are refreshed early, so that hosts
+    in use do not wait for DNS. :meth:`.stats` counts cache ``hits``,
+    ``misses``, ``stale`` answers, ``negative_hits``, background ``refreshes``
+    and ``evictions``.
     """
-    def __init__(self, loop, ipv6=True, nameservers=None):
+    def __init__(self, loop, ipv6=True, nameservers=None, cache_size=1024, negative_ttl=5,
+                 stale_ttl=30, refresh_ahead=2):
         """
         If ``ipv6`` is true, the resolver will prefer IPv6.
         """
         self.loop = loop
         self.resolver = aiodns.DNSResolver(loop=self.loop, nameservers=nameservers)
-        self.cached = {}
         self.ipv6 = ipv6
 
+        self.cache_size = cache_size
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.refresh_ahead = refresh_ahead
+
+        # Cached entries by address pair, least recently used first.
+        self.cached = collections.OrderedDict()
+
+        # When the first entry of each address pair expires.
+        self.fresh_until = {}
+
+        # When each failed lookup stops being cached, by address pair.
+        self.negative = collections.OrderedDict()
+
+        # Heap of (time, sequence, address pair) that says when an address
+        # pair has entries to purge.
+        self.expiry = []
+        self.sequence = itertools.count()
+
+        # Queries in flight by address pair, shared by concurrent lookups.
+        self.pending = {}
+
+        # Counters for cache events, see stats().
+        self.counters = collections.Counter()
+
     def add_to_cache(self, host, host_port, ip, ttl, port=80, overwrite=True):
         """
         Add the address pair ``host`` and ``host_port`` to the DNS cache pointing
@@ -36,34 +82,117 @@ class Resolver:
         if ttl:
             expires = time.time() + ttl
         else:
-            expires = 9999999999999
+            expires = FOREVER
 
         if overwrite or addr_pair not in self.cached:
             self.cached[addr_pair] = [(ip, port, expires)]
+            self.fresh_until[addr_pair] = expires
         else:
             self.cached[addr_pair].append((ip, port, expires))
+            self.fresh_until[addr_pair] = min(self.fresh_until[addr_pair], expires)
+
+        self.cached.move_to_end(addr_pair)
+        self.negative.pop(addr_pair, None)
+
+        if expires != FOREVER:
+            heapq.heappush(self.expiry, (expires + self.stale_ttl, next(self.sequence), addr_pair))
+
+        while len(self.cached) > self.cache_size:
+            evicted, _ = self.cached.popitem(last=False)
+            del self.fresh_until[evicted]
+            self.counters['evictions'] += 1
+
+    def add_negative(self, host, host_port):
+        """
+        Cache a failed lookup of the address pair ``host`` and ``host_port``
+        for ``negative_ttl`` seconds.
+        """
+        if not self.negative_ttl:
+            return
+
+        addr_pair = (host, host_port)
+
+        self.negative[addr_pair] = time.time() + self.negative_ttl
+        self.negative.move_to_end(addr_pair)
+
+        while len(self.negative) > self.cache_size:
+            self.negative.popitem(last=False)
+
+    def fetch_negative(self, host, host_port):
+        """
+        Return true if a failed lookup of the ``host`` and ``host_port``
+        address pair is cached.
+        """
+        addr_pair = (host, host_port)
+
+        expires = self.negative.get(addr_pair)
+        if expires is None:
+            return False
+
+        if expires <= time.time():
+            del self.negative[addr_pair]
+            return False
+
+        return True
 
     def fetch_from_cache(self, host, host_port):
         """
         Retrieve the cached entry for the ``host`` and ``host_port`` address
         pair. Returns ``None`` if there are no cached entries.
         """
+        cached = self.fetch_all_from_cache(host, host_port)
+
+        if cached:
+            return random.choice(cached)
+
+    def fetch_all_from_cache(self, host, host_port):
+        """
+        Retrieve all cached entries for the ``host`` and ``host_port`` address
+        pair that have not expired. Returns ``None`` if there are none.
+        """
         addr_pair = (host, host_port)
+        now = time.time()
+
+        self.purge(now)
 
-        if addr_pair not in self.cached:
+        cached = self.cached.get(addr_pair)
+        if not cached:
             return
 
-        self.filter_expired(addr_pair)
+        self.cached.move_to_end(addr_pair)
 
-        if self.cached[addr_pair]:
-            return random.choice(self.cached[addr_pair])
+        if now < self.fresh_until[addr_pair]:
+            return cached
+
+        return [ c for c in cached if c[2] > now ] or None
 
-    def filter_expired(self, addr_pair):
+    def purge(self, now):
         """
-        Remove expired entries from a cached address pair.
+        Remove entries that expired more than ``stale_ttl`` seconds ago.
         """
-        now = time.time()
-        self.cached[addr_pair] = list(filter(lambda c: c[2] > now, self.cached[addr_pair]))
+        while self.expiry and self.expiry[0][0] <= now:
+            _, _, addr_pair = heapq.heappop(self.expiry)
+
+            cached = self.cached.get(addr_pair)
+            if cached is None:
+                continue
+
+            cached = [ c for c in cached if c[2] + self.stale_ttl > now ]
+
+            if cached:
+                self.cached[addr_pair] = cached
+                self.fresh_until[addr_pair] = min(c[2] for c in cached)
+            else:
+                del self.cached[addr_pair]
+                del self.fresh_until[addr_pair]
+
+    def stats(self):
+        """
+        Return the cache counters and the number of cached address pairs.
+        """
+        stats = dict(self.counters)
+        stats['size'] = len(self.cached)
+        return stats
 
     async def resolve(self, host, port):
         """
@@ -72,31 +201,146 @@ class Resolver:
         if uvhttp.utils.is_ip(host):
             return (host, port)
 
-        cached = self.fetch_from_cache(host, port)
-        if cached:
-            return cached
+        addresses = await self.resolve_all(host, port)
+
+        # Pick from the preferred address family, which is listed first.
+        ipv6 = is_ipv6(addresses[0][0])
+        return random.choice([ a for a in addresses if is_ipv6(a[0]) == ipv6 ])
+
+    async def resolve_all(self, host, port):
+        """
+        Resolve ``host`` and ``port`` to all of its addresses. Returns a list
+        of ``(ip, port, expires)`` tuples in the order connections should be
+        attempted in (RFC 8305): IPv6 and IPv4 addresses alternate, starting
+        with IPv6 if the resolver prefers it.
+        """
+        if uvhttp.utils.is_ip(host):
+            return [ (host, port, FOREVER) ]
+
+        addr_pair = (host, port)
+        addresses = self.fetch_all_from_cache(host, port)
+
+        if addresses:
+            self.counters['hits'] += 1
+
+            if self.fresh_until[addr_pair] - time.time() < self.refresh_ahead:
+                self.refresh(host, port)
+        elif self.cached.get(addr_pair):
+            # Expired, but still usable while it is refreshed.
+            addresses = self.cached[addr_pair]
+            self.counters['stale'] += 1
+            self.refresh(host, port)
+        elif self.fetch_negative(host, port):
+            self.counters['negative_hits'] += 1
+        else:
+            self.counters['misses'] += 1
+            addresses = await self.lookup(host, port)
+
+        if not addresses:
+            raise DNSError()
 
+        ipv6 = [ a for a in addresses if is_ipv6(a[0]) ]
+        ipv4 = [ a for a in addresses if not is_ipv6(a[0]) ]
+
+        if not self.ipv6:
+            ipv6, ipv4 = ipv4, ipv6
+
+        ordered = []
+        for i in range(max(len(ipv6), len(ipv4))):
+            ordered.extend(ipv6[i:i + 1])
+            ordered.extend(ipv4[i:i + 1])
+
+        return ordered
+
+    def start_query(self, host, port):
+        """
+        Return the query in flight for ``host`` and ``port``, starting one if
+        there is none.
+        """
+        addr_pair = (host, port)
+
+        if addr_pair not in self.pending:
+            def done(future):
+                self.pending.pop(addr_pair, None)
+
+                # Nobody may be waiting for a background refresh.
+                if not future.cancelled():
+                    future.exception()
+
+            future = asyncio.ensure_future(self.query(host, port), loop=self.loop)
+            future.add_done_callback(done)
+            self.pending[addr_pair] = future
+
+        return self.pending[addr_pair]
+
+    async def lookup(self, host, port):
+        """
+        Query the DNS server for ``host`` and cache the results. Concurrent
+        lookups of the same address pair share a single query.
+        """
+        # Shielded so that a cancelled caller does not cancel the query for
+        # everyone else.
+        return await asyncio.shield(self.start_query(host, port), loop=self.loop)
+
+    def refresh(self, host, port):
+        """
+        Refresh the cached entries of ``host`` and ``port`` in the background.
+        """
+        if (host, port) in self.pending:
+            return
+
+        self.counters['refreshes'] += 1
+        self.start_query(host, port)
+
+    async def query(self, host, port):
+        """
+        Send the AAAA and A queries for ``host`` in parallel and cache the
+        results. Returns all cached entries for ``host`` and ``port``.
+
+        If no addresses are found, the entries already cached are kept so
+        that they can still be used until they go stale.
+        """
         if self.ipv6:
             query_types = ['AAAA', 'A']
         else:
             query_types = ['A']
 
-        for query_type in query_types:
-            try:
-                responses = await self.resolver.query(host, query_type)
-            except aiodns.error.DNSError as e:
-                pass
-            else:
-                # sometimes the resolver returns an empty list and I don't know why.
-                if not responses:
-                    continue
+        results = await asyncio.gather(*[ self.resolver.query(host, query_type)
+                for query_type in query_types ], loop=self.loop, return_exceptions=True)
 
-                for response in responses:
-                    self.add_to_cache(host, port, response.host, response.ttl, port=port)
-                break
+        responses = []
 
-        response = self.fetch_from_cache(host, port)
-        if not response:
-            raise DNSError()
-        else:
-            return response
+        # Only cache the failure if the host has no addresses, rather than
+        # if the server could not be reached.
+        negative = True
+
+        for result in results:
+            if isinstance(result, aiodns.error.DNSError):
+                if result.args[0] not in NEGATIVE_ERRORS:
+                    negative = False
+                continue
+            elif isinstance(result, Exception):
+                raise result
+
+            # sometimes the resolver returns an empty list and I don't know why.
+            responses.extend(result or [])
+
+        if not responses:
+            if negative:
+                self.add_negative(host, port)
+            return
+
+        for i, response in enumerate(responses):
+            self.add_to_cache(host, port, response.host, response.ttl, port=port,
+                              overwrite=i == 0)
+
+        return self.fetch_all_from_cache(host, port)
+
+def is_ipv6(ip):
+    """
+    Return True if ``ip`` is an IPv6 address.
+    """
+    if isinstance(ip, bytes):
+        return b':' in ip
+
+    return ':' in ip
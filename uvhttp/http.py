@@ -1,15 +1,53 @@
 import asyncio
+import collections
+import functools
 import json
+import sys
 import urllib
 import urllib.parse
 import zlib
 from httptools import HttpResponseParser, parse_url
 from uvhttp import pool
+import uvhttp.utils
+from uvhttp.buffer import ResponseBuffer
+from uvhttp.scheduler import FairScheduler
 from uvhttp.utils import HeaderDict
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 class EOFError(Exception):
     pass
 
+class StaleConnectionError(EOFError):
+    """
+    Raised when a kept-alive connection is closed by the server before any
+    of the response arrives, usually because the server timed it out while
+    it was idle in the pool.
+    """
+    pass
+
+# Methods that are safe to send twice when hedging.
+HEDGE_METHODS = frozenset([ b'GET', b'HEAD', b'OPTIONS' ])
+
+# Number of recent latencies kept per pool, and how many are needed before
+# they are used to pick the hedge delay.
+HEDGE_WINDOW = 100
+HEDGE_MIN_SAMPLES = 20
+
+# Response headers that decide how the response is read, picked out as they
+# are received so the header dictionary is only built when it is used.
+FRAMING_HEADERS = frozenset([ b'connection', b'content-encoding', b'content-length',
+    b'transfer-encoding' ])
+FRAMING_HEADER_LENGTHS = frozenset(len(name) for name in FRAMING_HEADERS)
+
 class Session:
     """
     A Session is an HTTP request pool that allows up to request_limit requests
@@ -36,14 +74,119 @@ class Session:
 
     The module is designed to send HTTP requests very quickly, so all methods
     require ``bytes`` objects instead of strings.
+
+    If ``request_limit`` is set, at most that many requests are in flight
+    across all hosts at once. Requests over the limit wait in a queue per
+    host and freed slots go to the hosts in turn, so one slow host cannot
+    starve the others (see :class:`uvhttp.scheduler.FairScheduler`). Idle
+    keep-alive connections count towards the limit too, and the least
+    recently used ones are closed to make room, so at most
+    ``request_limit`` sockets are open when crawling many hosts.
+
+    ``timeout``, ``connect_timeout`` and ``read_timeout`` set the default
+    timeouts (in seconds) for requests made with the session, see
+    :meth:`.request`.
+
+    If the server closes a kept-alive connection before any of the response
+    arrives, idempotent requests (GET, HEAD, PUT, DELETE, OPTIONS and TRACE)
+    are sent again on a new connection, up to ``retries`` times per request,
+    waiting ``retry_backoff`` seconds (doubling each time) in between. Other
+    requests raise :class:`.StaleConnectionError`. Retries are counted in
+    :meth:`uvhttp.pool.Pool.stats`.
+
+    If ``hedge_delay`` or ``hedge_percentile`` is set, GET, HEAD and OPTIONS
+    requests without a body that have no response after a delay are sent a
+    second time and the first response wins. The other attempt is cancelled
+    and its connection closed. The delay is the ``hedge_percentile``
+    percentile of the host's recent latencies once enough have been seen,
+    otherwise ``hedge_delay``. At most ``hedge_rate`` of requests are hedged.
+    The second attempt uses another connection and, if the pool balances
+    requests, usually another address. See :meth:`.hedge_stats`.
+
+    Gzip and deflate encoded responses are decompressed as they arrive (see
+    :class:`.Decompressor`) unless ``decompress`` is false. Set
+    ``accept_encoding=True`` to ask for them with an ``Accept-Encoding:
+    gzip, deflate`` header on every request (or pass the value to use).
+    The bytes received and after decompression are counted in
+    :meth:`uvhttp.pool.Pool.stats`.
+
+    JSON bodies are decoded straight from the response bytes with
+    ``json_loads``, by default ``orjson.loads`` or ``ujson.loads`` if one is
+    installed and :func:`json.loads` otherwise. :meth:`.HTTPRequest.json_async`
+    decodes bodies of ``json_offload_size`` bytes or more in
+    ``json_executor`` (by default the loop's thread pool) so the loop is not
+    stalled. Decoders written in C hold the GIL while they run, so pass a
+    :class:`concurrent.futures.ProcessPoolExecutor` to decode in parallel.
+
+    The pool, host and path of the last ``url_cache_size`` URLs requested
+    are cached so that they are not parsed again. When crawling many
+    different URLs, set ``url_cache='origin'`` to cache by origin
+    (scheme, host and port) instead and cut the path from the URL.
+
+    Any other keyword arguments are passed to each :class:`uvhttp.pool.Pool`
+    the session creates, for example:
+
+    * ``protocol=True`` feeds the response parser directly from an asyncio
+      protocol instead of going through streams.
+    * ``pipeline=n`` pipelines up to ``n`` idempotent requests on each
+      connection.
+    * ``reuse`` sets the order idle connections are reused in (``'lifo'`` or
+      ``'fifo'``).
+    * ``idle_timeout``, ``max_lifetime`` and ``max_requests`` limit how long
+      and how much connections are used before they are closed.
+    * ``happy_eyeballs_delay`` sets how long to wait for a connection to one
+      of a host's addresses before racing the next one.
+    * ``balance`` spreads requests across a host's addresses
+      (``'least_outstanding'`` or ``'power_of_two'``).
     """
-    def __init__(self, conn_limit, loop, resolver=None):
+    def __init__(self, conn_limit, loop, resolver=None, request_limit=None, timeout=None,
+                 connect_timeout=None, read_timeout=None, hedge_delay=None,
+                 hedge_percentile=None, hedge_rate=0.05, retries=2, retry_backoff=0,
+                 url_cache_size=1024, url_cache='url', accept_encoding=None, decompress=True,
+                 json_loads=None, json_offload_size=None, json_executor=None, **pool_kwargs):
         self.conn_limit = conn_limit
         self.loop = loop
         self.resolver = resolver
+        self.pool_kwargs = pool_kwargs
+
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        if accept_encoding is True:
+            accept_encoding = ACCEPT_ENCODING
+        self.accept_encoding = accept_encoding
+        self.decompress = decompress
+
+        self.json_loads = json_loads or default_json_loads()
+        self.json_offload_size = json_offload_size
+        self.json_executor = json_executor
+
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.hedge_rate = hedge_rate
+        self.hedging = hedge_delay is not None or hedge_percentile is not None
+
+        # Recent latencies by pool and hedging counters, see hedge_stats().
+        self.latencies = {}
+        self.hedges = collections.Counter()
+
+        self.request_limit = request_limit
+        if request_limit:
+            self.scheduler = FairScheduler(request_limit, loop)
+        else:
+            self.scheduler = None
 
         self.hosts = {}
 
+        # Recently requested URLs (or origins), see lookup().
+        self.url_cache_size = url_cache_size
+        self.url_cache = url_cache
+        self.urls = collections.OrderedDict()
+
     async def head(self, *args, **kwargs):
         """
         Make an HTTP HEAD request to url, see :meth:`.head`.
@@ -74,7 +217,8 @@ class Session:
         """
         return await self.request(b'DELETE', *args, **kwargs)
 
-    async def request(self, method, url, headers=None, data=None, ssl=None):
+    async def request(self, method, url, headers=None, data=None, ssl=None, stream=False,
+                      priority=0, timeout=None, connect_timeout=None, read_timeout=None):
         """
         Make a new HTTP request in the pool.
 
@@ -84,6 +228,256 @@ class Session:
 
         ``ssl`` can be a :class:`ssl.SSLContext` or True and must match
         the schema in the URL.
+
+        If ``stream`` is true, the request is returned as soon as the headers
+        are received and the body must be consumed with
+        :meth:`.HTTPRequest.iter_chunks` (or the request closed with
+        :meth:`.HTTPRequest.close`) to release the connection.
+
+        If the host has no free connections, requests with a lower
+        ``priority`` get one first (see :class:`uvhttp.pool.Pool`).
+
+        Timeouts are in seconds and default to the session's:
+
+        * ``timeout`` is the deadline for the whole request, from waiting for
+          a connection to reading the end of the body (or, when streaming,
+          the headers). A request still waiting for a connection when it
+          passes fails without using one.
+        * ``connect_timeout`` limits resolving the host and, separately,
+          connecting and the TLS handshake.
+        * ``read_timeout`` limits waiting for the response once the request
+          is sent (for streaming requests, for each chunk).
+
+        :class:`asyncio.TimeoutError` is raised when one runs out, and a
+        connection that was in use is closed and released back to the pool.
+        """
+        session, host, path = self.lookup(url, ssl)
+
+        return await self.dispatch(session, method, host, path, None, headers, data, stream,
+                priority, timeout, connect_timeout, read_timeout)
+
+    def prepare(self, method, url, headers=None, ssl=None):
+        """
+        Return a :class:`.PreparedRequest` for sending ``method`` requests to
+        ``url`` with ``headers`` again and again, without parsing the URL and
+        serializing the headers each time.
+        """
+        session, host, path = self.lookup(url, ssl)
+        return PreparedRequest(self, session, method, host, path,
+                serialize_head(method, host, path, headers, accept_encoding=self.accept_encoding))
+
+    def map(self, requests, concurrency=10, ordered=False, return_exceptions=False):
+        """
+        Send ``requests`` with at most ``concurrency`` in flight and return a
+        :class:`.RequestMap` yielding ``(request, response)`` pairs::
+
+            urls = (b'http://www.google.com/?q=' + str(i).encode() for i in range(100000))
+
+            async for url, response in session.map(urls, concurrency=100):
+                print(url, response.status_code)
+
+        ``requests`` is an iterable or asynchronous iterable of URLs (sent as
+        GET requests), tuples of arguments for :meth:`.request` or
+        :class:`.PreparedRequest` objects. It is only read as fast as
+        requests are sent, so it can be arbitrarily long.
+
+        Pairs are yielded as requests complete, or in the order of
+        ``requests`` if ``ordered`` is true. If a request fails, its error is
+        raised and the remaining requests are cancelled unless
+        ``return_exceptions`` is true, in which case the error is yielded in
+        place of the response.
+        """
+        return RequestMap(self, requests, concurrency, ordered, return_exceptions)
+
+    async def dispatch(self, session, method, host, path, head, headers, data, stream, priority,
+                       timeout, connect_timeout, read_timeout):
+        """
+        Send a request to the pool ``session``, see :meth:`.request`.
+        """
+        timeout = timeout or self.timeout
+        if timeout:
+            deadline = self.loop.time() + timeout
+        else:
+            deadline = None
+
+        send = functools.partial(self.send_request, session, method, host, path, head, headers,
+                data, stream, priority, deadline, connect_timeout or self.connect_timeout,
+                read_timeout or self.read_timeout)
+
+        if self.hedging and method in HEDGE_METHODS and not data and not stream:
+            return await self.hedge(session, send)
+
+        return await send()
+
+    async def send_request(self, session, method, host, path, head, headers, data, stream,
+                           priority, deadline, connect_timeout, read_timeout):
+        """
+        Get a connection from the pool ``session`` and send a request on it,
+        see :meth:`.request`.
+        """
+        retries = 0
+
+        while True:
+            try:
+                return await self.send_attempt(session, method, host, path, head, headers,
+                        data, stream, priority, deadline, connect_timeout, read_timeout,
+                        fresh=retries > 0)
+            except StaleConnectionError:
+                session.counters['stale_connections'] += 1
+
+                if method not in pool.REPLAY_METHODS or retries >= self.retries:
+                    session.counters['retries_exhausted'] += 1
+                    raise
+
+                if self.retry_backoff:
+                    await uvhttp.utils.wait_for(asyncio.sleep(
+                        self.retry_backoff * 2 ** retries, loop=self.loop), deadline, self.loop)
+
+                retries += 1
+                session.counters['retries'] += 1
+
+    async def send_attempt(self, session, method, host, path, head, headers, data, stream,
+                           priority, deadline, connect_timeout, read_timeout, fresh=False):
+        """
+        Make a single attempt at sending a request, see :meth:`.send_request`.
+        If ``fresh`` is true, the request is sent on a new socket.
+        """
+        connection = await session.connect(priority, deadline, fresh=fresh,
+                connect_timeout=connect_timeout)
+
+        # Wait for a slot only once the host can take the request, so that
+        # requests queued behind a busy host do not hold slots.
+        if self.scheduler:
+            try:
+                await uvhttp.utils.wait_for(self.scheduler.acquire(session), deadline, self.loop)
+            except:
+                connection.release()
+                raise
+
+            self.scheduler.reserve(connection)
+
+        # Create and send the new HTTP request.
+        request = HTTPRequest(connection, scheduler=self.scheduler, deadline=deadline,
+                connect_timeout=connect_timeout, read_timeout=read_timeout,
+                accept_encoding=self.accept_encoding, decompress=self.decompress,
+                json_loads=self.json_loads, json_offload_size=self.json_offload_size,
+                json_executor=self.json_executor)
+
+        try:
+            await request.send(method, host, path, headers, data, stream=stream, head=head)
+        except:
+            # Release the connection (and slot) if the request failed before
+            # its response was read.
+            request.abort()
+            raise
+
+        return request
+
+    async def hedge(self, session, send):
+        """
+        Call ``send`` and, if it has not returned after the hedge delay, call
+        it again. Returns the first successful result.
+        """
+        start = self.loop.time()
+        self.hedges['requests'] += 1
+
+        attempts = [ asyncio.ensure_future(send(), loop=self.loop) ]
+
+        try:
+            delay = self.hedge_delay_for(session)
+
+            if delay is not None:
+                done, pending = await asyncio.wait(attempts, timeout=delay, loop=self.loop)
+
+                if not done and self.hedges['hedged'] < self.hedge_rate * self.hedges['requests']:
+                    self.hedges['hedged'] += 1
+                    attempts.append(asyncio.ensure_future(send(), loop=self.loop))
+
+            winner = await first_success(attempts, self.loop)
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                elif not attempt.cancelled():
+                    # Mark the error of a losing attempt as retrieved.
+                    attempt.exception()
+
+        if len(attempts) > 1:
+            if winner is attempts[1]:
+                self.hedges['hedge_wins'] += 1
+            else:
+                self.hedges['hedge_losses'] += 1
+
+        latencies = self.latencies.get(session)
+        if latencies is None:
+            latencies = self.latencies[session] = collections.deque(maxlen=HEDGE_WINDOW)
+
+        latencies.append(self.loop.time() - start)
+
+        return winner.result()
+
+    def hedge_delay_for(self, session):
+        """
+        Return how long to wait before hedging a request to the pool
+        ``session``.
+        """
+        if self.hedge_percentile:
+            latencies = self.latencies.get(session)
+
+            if latencies and len(latencies) >= HEDGE_MIN_SAMPLES:
+                latencies = sorted(latencies)
+                index = int(len(latencies) * self.hedge_percentile / 100)
+                return latencies[min(index, len(latencies) - 1)]
+
+        return self.hedge_delay
+
+    def hedge_stats(self):
+        """
+        Return the number of hedgeable ``requests``, how many were ``hedged``,
+        how often the second attempt won (``hedge_wins``) or lost
+        (``hedge_losses``), and the ``win_rate`` of hedges. Every key is
+        present, counting from 0.
+        """
+        hedges = self.hedges
+        return {
+            'requests': hedges['requests'],
+            'hedged': hedges['hedged'],
+            'hedge_wins': hedges['hedge_wins'],
+            'hedge_losses': hedges['hedge_losses'],
+            'win_rate': hedges['hedge_wins'] / max(hedges['hedged'], 1)
+        }
+
+    def lookup(self, url, ssl=None):
+        """
+        Return the :class:`uvhttp.pool.Pool` for ``url`` (creating it if it
+        does not exist yet), the host and the path to request.
+        """
+        if not self.url_cache_size:
+            return self.parse(url, ssl)
+
+        if self.url_cache == 'origin':
+            key, path = split_origin(url)
+        else:
+            key, path = url, None
+
+        cached = self.urls.get(key)
+        if cached is not None:
+            self.urls.move_to_end(key)
+        else:
+            cached = self.urls[key] = self.parse(url, ssl)
+
+            if len(self.urls) > self.url_cache_size:
+                self.urls.popitem(last=False)
+
+        if path is None:
+            return cached
+
+        return cached[0], cached[1], path
+
+    def parse(self, url, ssl=None):
+        """
+        Parse ``url`` and return the pool, host and path for it, see
+        :meth:`.lookup`.
         """
 
         # Parse the URL for the hostname, port, and query string.
@@ -110,13 +504,33 @@ class Session:
 
         session = self.hosts.get(addr)
         if not session:
-            session = pool.Pool(host, port, self.conn_limit, self.loop, resolver=self.resolver, ssl=ssl)
+            session = pool.Pool(host, port, self.conn_limit, self.loop, resolver=self.resolver, ssl=ssl,
+                    **self.pool_kwargs)
             self.hosts[addr] = session
 
-        # Create and send the new HTTP request.
-        request = HTTPRequest(await session.connect())
-        await request.send(method, host, path, headers, data)
-        return request
+        return session, host, path
+
+    async def warmup(self, url, connections=1, ssl=None):
+        """
+        Open up to ``connections`` connections (including the TLS handshake)
+        to the host in ``url`` before any requests are made to it, so that the
+        first requests do not have to wait for DNS, TCP and TLS.
+
+        Returns the timing statistics from :meth:`uvhttp.pool.Pool.warmup`.
+        """
+        session, host, path = self.lookup(url, ssl)
+        return await session.warmup(connections)
+
+    async def warmup_many(self, urls, connections=1, ssl=None):
+        """
+        Warm up the pools for all of ``urls`` concurrently, see
+        :meth:`.warmup`. Returns a dictionary of URL to timing statistics.
+        """
+        results = await asyncio.gather(*[
+            self.warmup(url, connections=connections, ssl=ssl) for url in urls
+        ], loop=self.loop)
+
+        return dict(zip(urls, results))
 
     async def connections(self):
         connections = 0
@@ -126,17 +540,153 @@ class Session:
 
         return connections
 
+    def close(self):
+        """
+        Close all of the pools in the session.
+        """
+        for host_pool in self.hosts.values():
+            host_pool.close()
+
+        self.hosts = {}
+        self.urls.clear()
+
+def split_origin(url):
+    """
+    Split ``url`` into its origin (everything up to the path) and the path
+    and query to request, without parsing it.
+    """
+    start = url.find(b'://') + 3
+
+    end = len(url)
+    for separator in (b'/', b'?', b'#'):
+        index = url.find(separator, start, end)
+        if index != -1:
+            end = index
+
+    path = url[end:]
+
+    index = path.find(b'#')
+    if index != -1:
+        path = path[:index]
+
+    if not path.startswith(b'/'):
+        path = b'/' + path
+
+    return url[:end], path
+
+def serialize_head(method, host, path, headers=None, data=None, accept_encoding=None):
+    """
+    Return the request line and headers of a request, without the blank line
+    that ends them. ``headers`` override the default headers.
+    """
+    request_headers = {
+        b"Host": host,
+        b"User-Agent": b"uvloop http client"
+    }
+
+    if accept_encoding:
+        request_headers[b"Accept-Encoding"] = accept_encoding
+
+    if data:
+        request_headers[b"Content-Length"] = str(len(data)).encode()
+
+    if headers:
+        request_headers.update(headers)
+
+    return b"".join(
+        [ b" ".join([method, path, b"HTTP/1.1\r\n"]) ] +
+        [ name + b": " + value + b"\r\n" for name, value in request_headers.items() ]
+    )
+
+async def first_success(tasks, loop):
+    """
+    Wait for the first of ``tasks`` to succeed and return it, or raise the
+    last error if they all fail.
+    """
+    pending = tasks
+    error = None
+
+    while pending:
+        done, pending = await asyncio.wait(pending, loop=loop,
+                return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            if task.exception() is None:
+                return task
+
+            error = task.exception()
+
+    raise error
+
+class PreparedRequest:
+    """
+    A request to the same URL with the same headers that can be sent many
+    times, returned by :meth:`.Session.prepare`::
+
+        prepared = session.prepare(b'GET', b'http://www.google.com/', headers={
+            b'User-Agent': b'fast-af'
+        })
+
+        for _ in range(6):
+            response = await prepared.send()
+
+    The pool for the URL is looked up and the request line and headers are
+    serialized once, when the request is prepared. Closing the session
+    closes the pool, so prepare requests again after :meth:`.Session.close`.
+    """
+    def __init__(self, session, pool, method, host, path, head):
+        self.session = session
+        self.pool = pool
+        self.method = method
+        self.host = host
+        self.path = path
+        self.head = head
+
+    async def send(self, headers=None, data=None, stream=False, priority=0, timeout=None,
+                   connect_timeout=None, read_timeout=None):
+        """
+        Send the request, see :meth:`.Session.request`. ``headers`` are added
+        to the prepared headers and must not repeat them.
+        """
+        return await self.session.dispatch(self.pool, self.method, self.host, self.path,
+                self.head, headers, data, stream, priority, timeout, connect_timeout,
+                read_timeout)
+
 class HTTPRequest:
     """
     An HTTP request instantiated from a :class:`.Session`. HTTP requests are returned by the HTTP
     session once they are sent and contain all information about the request and response.
     """
-    def __init__(self, connection):
+    def __init__(self, connection, scheduler=None, deadline=None, connect_timeout=None,
+                 read_timeout=None, accept_encoding=None, decompress=True, json_loads=None,
+                 json_offload_size=None, json_executor=None):
         self.connection = connection
 
-    async def send(self, method, host, path, headers=None, data=None):
+        # See Session.
+        self.accept_encoding = accept_encoding
+        self.decompress = decompress
+        self.json_loads = json_loads or default_json_loads()
+        self.json_offload_size = json_offload_size
+        self.json_executor = json_executor
+
+        # The session's FairScheduler, if any, released with the connection.
+        self.scheduler = scheduler
+
+        # Timeouts, see Session.request().
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.closed = False
+
+    async def send(self, method, host, path, headers=None, data=None, stream=False, head=None):
         """
         Send the request (usually called by the Session object).
+
+        If ``stream`` is true, only the headers are read before returning.
+
+        ``head`` is the request line and headers from :func:`.serialize_head`,
+        in which case ``headers`` are added to it as they are.
         """
         self.__keep_alive = None
         self.__gzipped = None
@@ -144,73 +694,210 @@ class HTTPRequest:
         self.headers_complete = False
         self.contains_body = False
         self.body_done = True
+        self.response_begun = False
+
+        self.stream = stream
+        self.chunks = collections.deque()
+        self.closed = False
+
+        self.status_code = 0
 
         self.__text = b''
-        self.content = b''
-        self.__headers = {}
+        self.body = ResponseBuffer()
+        self.decompressor = None
+        self.__headers = []
         self.__header_dict = None
+        self.__framing = {}
         self.parser = HttpResponseParser(self)
 
         self.method = method
 
-        self.request_headers = {
-            b"Host": host,
-            b"User-Agent": b"uvloop http client"
-        }
+        if head is None:
+            request = serialize_head(method, host, path, headers, data, self.accept_encoding)
+        else:
+            # A prepared head, finish it with the headers for this request.
+            request = head
 
-        if data:
-            self.request_headers[b"Content-Length"] = str(len(data)).encode()
+            if headers:
+                request += b"".join([ name + b": " + value + b"\r\n"
+                    for name, value in headers.items() ])
 
-        if headers:
-            self.request_headers.update(headers)
+            if data:
+                request += b"Content-Length: " + str(len(data)).encode() + b"\r\n"
 
-        request = b"\r\n".join(
-            [ b" ".join([method, path, b"HTTP/1.1"]) ] +
-            [ b": ".join(header) for header in self.request_headers.items() ] +
-            [ b"\r\n" ]
-        )
+        request += b"\r\n"
 
         if data:
             request += data
 
-        await self.connection.send(request)
+        # Nothing was sent yet, so the connection can be reused as is.
+        if self.deadline is not None and self.connection.loop.time() >= self.deadline:
+            if self.connection.pool:
+                self.connection.pool.counters['shed'] += 1
+
+            self.close()
+            raise asyncio.TimeoutError()
+
+        # A connection that is already open may have been closed by the server
+        # while it was idle, which only shows once it is used.
+        reused = self.connection.connected
 
         try:
+            await self.with_timeout(self.connection.send(request, self), self.connect_timeout)
             await self.fetch()
-        except EOFError as e:
-            if self.headers[b'transfer-encoding'] \
-              or self.headers[b'content-encoding'] or self.headers[b'content-length']:
+
+            # The deadline only covers the headers of a streaming response,
+            # the body is read at the caller's pace.
+            if self.stream:
+                self.deadline = None
+        except (EOFError, ConnectionResetError, BrokenPipeError) as e:
+            if not self.response_begun:
+                self.abort()
+
+                if reused:
+                    raise StaleConnectionError() from e
+
+                raise EOFError() from e
+
+            if not isinstance(e, EOFError) or self.delimited:
                 raise e
 
-        self.status_code = self.parser.get_status_code()
+    @property
+    def delimited(self):
+        """
+        Return true if the end of the body is signalled by the headers rather
+        than by the server closing the connection.
+        """
+        framing = self.__framing
+        return bool(framing.get(b'transfer-encoding') or framing.get(b'content-encoding') \
+            or framing.get(b'content-length'))
+
+    @property
+    def waiting(self):
+        """
+        Return true if more data must be read from the connection before the
+        request can make progress.
+        """
+        if not self.headers_complete:
+            return True
+
+        if self.stream:
+            return not self.body_done and not self.chunks
+
+        return not self.body_done
 
     async def fetch(self):
-        # TODO: support streaming
-        while not self.headers_complete or not self.body_done:
-            data = await self.connection.read(65535)
+        """
+        Read from the connection until the response is complete or, for
+        streaming requests, until the headers are complete.
+        """
+        if not await self.with_timeout(self.connection.receive(self), self.read_timeout):
+            # The server closed the connection.
+            self.abort()
+            raise EOFError()
 
-            if not data:
-                self.close()
-                raise EOFError()
+        if self.body_done:
+            self.close()
+
+    async def with_timeout(self, coro, timeout):
+        """
+        Await ``coro`` for up to ``timeout`` seconds or until the request's
+        deadline, aborting the request if it times out.
+        """
+        if self.deadline is not None:
+            remaining = self.deadline - self.connection.loop.time()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+
+        if timeout is None:
+            return await coro
+
+        try:
+            if timeout <= 0:
+                coro.close()
+                raise asyncio.TimeoutError()
+
+            return await asyncio.wait_for(coro, timeout, loop=self.connection.loop)
+        except asyncio.TimeoutError:
+            if self.connection.pool:
+                self.connection.pool.counters['timeouts'] += 1
+
+            self.abort()
+            raise
+
+    def iter_chunks(self):
+        """
+        Return an asynchronous iterator over the body of a streaming request::
+
+            response = await session.get(url, stream=True)
+
+            async for chunk in response.iter_chunks():
+                handle(chunk)
+
+        The body is read from the connection only as chunks are consumed and
+        the connection is released back to the pool once the body is done.
+        """
+        return ChunkIterator(self)
+
+    async def read_chunk(self):
+        """
+        Return the next chunk of a streaming response body, or ``None`` once
+        the body has been fully consumed.
+        """
+        try:
+            if self.waiting:
+                await self.fetch()
+        except EOFError as e:
+            if self.delimited:
+                raise e
 
-            self.parser.feed_data(data)
+            self.body_done = True
 
-        self.close()
+        if self.chunks:
+            return self.chunks.popleft()
 
     def close(self):
         """
         Closes the request, signalling that we're done with the request. The
         connection is kept open and released back to the pool for re-use.
+
+        Closing a streaming request before its body has been consumed closes
+        the underlying connection.
         """
-        if not self.keep_alive:
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if not self.keep_alive or not self.body_done:
             self.connection.close()
 
         self.connection.release()
 
+        if self.scheduler:
+            self.scheduler.release(self.connection)
+
+    def abort(self):
+        """
+        Close the request and its connection, for when the response will not
+        be read (the request failed or timed out). The connection is released
+        back to the pool and reconnects when it is next used.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+
+        self.connection.close()
+        self.connection.release()
+
+        if self.scheduler:
+            self.scheduler.release()
+
     @property
     def keep_alive(self):
         if self.__keep_alive == None:
-            connection = self.headers[b'connection']
+            connection = self.__framing.get(b'connection')
             self.__keep_alive = not connection or connection != b'close'
 
         return self.__keep_alive
@@ -221,62 +908,420 @@ class HTTPRequest:
         Return true if the response is gzipped.
         """
         if self.__gzipped == None:
-            encoding = self.headers[b'content-encoding'] + self.headers[b'transfer-encoding']
-            self.__gzipped = b'gzip' in encoding or b'deflate' in encoding
+            self.__gzipped = content_coding(self.__framing) is not None
 
         return self.__gzipped
 
     def json(self):
         """
-        Return the JSON decoded version of the body.
+        Return the JSON decoded version of the body, decoded from the bytes
+        of the body without making a string of it first.
+        """
+        return self.json_loads(self.decoded_content)
+
+    async def json_async(self):
+        """
+        Return the JSON decoded version of the body like :meth:`.json`, but
+        decode large bodies in an executor, see :class:`.Session`.
         """
-        # TODO: Possibly should use a better library.
-        return json.loads(self.text)
+        content = self.decoded_content
+
+        if self.json_offload_size is None or len(content) < self.json_offload_size:
+            return self.json_loads(content)
+
+        return await self.connection.loop.run_in_executor(self.json_executor, self.json_loads,
+                content)
+
+    @property
+    def decoded_content(self):
+        """
+        The response body as :class:`bytes`, decompressed even if the session
+        does not decompress responses as they arrive.
+        """
+        if self.gzipped and not self.decompressor:
+            decompressor = Decompressor(content_coding(self.__framing))
+            return decompressor.decompress(self.content) + decompressor.flush()
+
+        return self.content
 
     @property
     def text(self):
         """
         The string representation of the response body. It will be ungzipped
-        and encoded as a unicode string.
+        (if it was not decompressed as it arrived) and encoded as a unicode
+        string.
         """
         if self.__text:
             return self.__text
 
-        if self.gzipped:
-            self.__text = zlib.decompress(self.content, 16 + zlib.MAX_WBITS)
-        else:
-            self.__text = self.content
-
-        self.__text = self.__text.decode('utf-8')
+        self.__text = self.decoded_content.decode('utf-8')
         return self.__text
 
     @property
     def headers(self):
         """
-        Return the headers from the request in a case-insensitive dictionary.
+        Return the headers from the request in a case-insensitive dictionary
+        (a :class:`uvhttp.utils.HeaderDict`).
         """
-        if self.headers_complete and self.__header_dict:
-            return self.__header_dict
+        if self.__header_dict is None:
+            self.__header_dict = HeaderDict(self.__headers)
 
-        self.__header_dict = HeaderDict(self.__headers)
         return self.__header_dict
 
     def on_header(self, name, value):
+        self.__headers.append((name, value))
 
-        self.__headers[name] = value
+        if len(name) in FRAMING_HEADER_LENGTHS:
+            name = name.lower()
+            if name in FRAMING_HEADERS:
+                self.__framing[name] = value
+
+    @property
+    def content(self):
+        """
+        The response body as :class:`bytes`, decompressed if the session
+        decompresses responses.
+        """
+        return self.body.getvalue()
 
     def on_body(self, body):
-        self.content += body
+        if self.decompressor:
+            body = self.decompressor.decompress(body)
+            if not body:
+                return
+
+        if self.stream:
+            self.chunks.append(body)
+            return
+
+        self.body.append(body)
 
     def on_headers_complete(self):
         self.headers_complete = True
+        self.status_code = self.parser.get_status_code()
+
+        if self.decompress and not self.body_done:
+            coding = content_coding(self.__framing)
+            if coding:
+                self.decompressor = Decompressor(coding)
 
     def on_chunk_complete(self):
-        self.body_done = True
+        pass
 
     def on_message_complete(self):
+        if self.decompressor:
+            self.finish_decompressing()
+
         self.body_done = True
 
+    def finish_decompressing(self):
+        """
+        Add the end of the decompressed body and count the bytes received
+        and decompressed in the pool.
+        """
+        body = self.decompressor.flush()
+        if body:
+            if self.stream:
+                self.chunks.append(body)
+            else:
+                self.body.append(body)
+
+        pool = self.connection.pool
+        if pool:
+            pool.counters['compressed_bytes'] += self.decompressor.compressed
+            pool.counters['decompressed_bytes'] += self.decompressor.decompressed
+
     def on_message_begin(self):
+        self.response_begun = True
+
         if self.method != b"HEAD":
             self.body_done = False
+
+def default_json_loads():
+    """
+    Return the fastest available function that decodes JSON from bytes.
+    """
+    if orjson:
+        return orjson.loads
+
+    if ujson:
+        return ujson.loads
+
+    if sys.version_info >= (3, 6):
+        return json.loads
+
+    return decode_json
+
+def decode_json(data):
+    """
+    Decode JSON from bytes on Python 3.5, where :func:`json.loads` only
+    accepts strings.
+    """
+    return json.loads(data.decode('utf-8'))
+
+# The Accept-Encoding header sent with Session(accept_encoding=True).
+ACCEPT_ENCODING = b'gzip, deflate'
+
+def content_coding(headers):
+    """
+    Return the compression a response body was encoded with (``b'gzip'`` or
+    ``b'deflate'``), or None. ``headers`` maps lowercase names to values.
+    """
+    encoding = (headers.get(b'content-encoding') or headers.get(b'transfer-encoding')
+        or b'').lower()
+
+    if b'gzip' in encoding:
+        return b'gzip'
+
+    if b'deflate' in encoding:
+        return b'deflate'
+
+class Decompressor:
+    """
+    Decompresses a gzip or deflate encoded body piece by piece as it is
+    received. Deflate bodies are accepted both with the zlib wrapper (as the
+    standard requires) and raw (as some servers send them).
+    """
+    def __init__(self, coding):
+        self.coding = coding
+
+        if coding == b'gzip':
+            self.decompressobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressobj = None
+
+        # Data held back until the deflate wrapper can be told apart.
+        self.pending = b''
+
+        # Bytes fed in and returned.
+        self.compressed = 0
+        self.decompressed = 0
+
+    def decompress(self, data):
+        """
+        Return as much of the decompressed body as is available after adding
+        ``data``.
+        """
+        self.compressed += len(data)
+
+        if self.decompressobj is None:
+            data = self.pending + data
+            if len(data) < 2:
+                self.pending = data
+                return b''
+
+            self.pending = b''
+            self.decompressobj = zlib.decompressobj(
+                zlib.MAX_WBITS if is_zlib_header(data) else -zlib.MAX_WBITS)
+
+        data = self.decompressobj.decompress(data)
+        self.decompressed += len(data)
+        return data
+
+    def flush(self):
+        """
+        Return the rest of the decompressed body once all of it was added.
+        """
+        data = b''
+
+        if self.decompressobj is None:
+            # The body was too short for a zlib wrapper.
+            self.decompressobj = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self.decompressobj.decompress(self.pending)
+            self.pending = b''
+
+        data += self.decompressobj.flush()
+        self.decompressed += len(data)
+        return data
+
+def is_zlib_header(data):
+    """
+    Return true if ``data`` starts with a zlib header rather than raw
+    deflate data.
+    """
+    return data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0
+
+class ChunkIterator:
+    """
+    Asynchronous iterator over the body of a streaming :class:`.HTTPRequest`.
+    """
+    def __init__(self, request):
+        self.request = request
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.request.read_chunk()
+        if chunk is None:
+            raise StopAsyncIteration
+
+        return chunk
+
+class RequestMap:
+    """
+    Asynchronous iterator over the responses to many requests, returned by
+    :meth:`.Session.map`.
+
+    A fixed set of ``concurrency`` worker tasks take requests from the input
+    and send them. Workers stop taking requests when ``2 * concurrency``
+    responses are waiting to be consumed, so memory use does not grow with
+    the length of the input. Call :meth:`.close` to stop early.
+    """
+    def __init__(self, session, requests, concurrency, ordered, return_exceptions):
+        self.session = session
+        self.loop = session.loop
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.return_exceptions = return_exceptions
+
+        if hasattr(requests, '__aiter__'):
+            self.requests = requests.__aiter__()
+            self.lock = asyncio.Lock(loop=self.loop)
+        else:
+            self.requests = iter(requests)
+            self.lock = None
+
+        # Requests taken from the input but not consumed yet.
+        self.slots = asyncio.Semaphore(concurrency * 2, loop=self.loop)
+
+        # Completed (request, response) pairs, by input index when ordered.
+        if ordered:
+            self.results = {}
+        else:
+            self.results = collections.deque()
+
+        self.taken = 0
+        self.yielded = 0
+        self.exhausted = False
+        self.error = None
+
+        self.workers = None
+        self.active = 0
+        self.waiter = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.workers is None:
+            self.active = self.concurrency
+            self.workers = [ asyncio.ensure_future(self.work(), loop=self.loop)
+                for _ in range(self.concurrency) ]
+
+        while True:
+            if self.ordered:
+                result = self.results.pop(self.yielded, None)
+            elif self.results:
+                result = self.results.popleft()
+            else:
+                result = None
+
+            if result is not None:
+                break
+
+            if not self.active:
+                if self.error is not None:
+                    error, self.error = self.error, None
+                    raise error
+
+                raise StopAsyncIteration
+
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            finally:
+                self.waiter = None
+
+        self.yielded += 1
+        self.slots.release()
+
+        request, response = result
+        if isinstance(response, Exception) and not self.return_exceptions:
+            self.close()
+            raise response
+
+        return result
+
+    async def work(self):
+        """
+        Send requests until the input is exhausted.
+        """
+        try:
+            while not self.exhausted:
+                await self.slots.acquire()
+
+                try:
+                    request = await self.next_request()
+                except Exception as e:
+                    self.error = e
+                    self.exhausted = True
+
+                if self.exhausted:
+                    self.slots.release()
+                    return
+
+                index = self.taken
+                self.taken += 1
+
+                try:
+                    response = await self.send(request)
+                except Exception as e:
+                    response = e
+
+                if self.ordered:
+                    self.results[index] = (request, response)
+                else:
+                    self.results.append((request, response))
+
+                self.wakeup()
+        finally:
+            self.active -= 1
+            self.wakeup()
+
+    async def next_request(self):
+        """
+        Return the next request from the input, setting ``exhausted`` once
+        there are none left.
+        """
+        if self.lock is None:
+            try:
+                return next(self.requests)
+            except StopIteration:
+                self.exhausted = True
+                return
+
+        # Asynchronous generators cannot be advanced by two workers at once.
+        async with self.lock:
+            if self.exhausted:
+                return
+
+            try:
+                return await self.requests.__anext__()
+            except StopAsyncIteration:
+                self.exhausted = True
+
+    async def send(self, request):
+        if isinstance(request, PreparedRequest):
+            return await request.send()
+
+        if isinstance(request, bytes):
+            return await self.session.get(request)
+
+        return await self.session.request(*request)
+
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self):
+        """
+        Stop sending requests and cancel the ones in flight.
+        """
+        self.exhausted = True
+
+        for worker in self.workers or []:
+            worker.cancel()
@@ -1,8 +1,16 @@
 import asyncio
+import collections
+import functools
+import heapq
+import itertools
+import random
 import socket
+import ssl
+import time
 import uvhttp.dns
 import uvhttp.utils
 import uvloop
+from httptools import HttpResponseParser
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
@@ -12,9 +20,12 @@ class Connection:
     the connection is locked until release() is called, when it will be
     released back into the pool.
     """
-    def __init__(self, host, port, pool_available, loop, ssl=None, hostname=None):
+    def __init__(self, host, port, pool_available, loop, ssl=None, hostname=None, pool=None):
         self.loop = loop
 
+        # The Pool the connection belongs to, if any.
+        self.pool = pool
+
         # Semaphore used by the Pool to determine if any connections are
         # available.
         self.pool_available = pool_available
@@ -39,14 +50,77 @@ class Connection:
         # Number of reconnects made. Used to determine pool efficiency.
         self.connect_count = 0
 
+        # When the socket was opened and last released, and how many requests
+        # have been made on it. Used by the pool to expire connections.
+        self.connected_at = None
+        self.last_used = None
+        self.requests = 0
+
+        # The SubPool of the address the connection is pinned to, if the pool
+        # balances requests across addresses.
+        self.subpool = None
+
+    @property
+    def connected(self):
+        """
+        Return true if the socket is open.
+        """
+        return self.writer is not None
+
+    @property
+    def idle(self):
+        """
+        Return true if no requests are using the connection.
+        """
+        return not self.locked
+
     async def connect(self):
         """
         Open a new connection to the server. Should only be called when the
         connection has not established yet or we disconnected.
         """
+        address = await self.address()
+
         self.connect_count += 1
-        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, loop=self.loop,
-                ssl=self.ssl, server_hostname=self.hostname)
+        self.connected_at = self.loop.time()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(loop=self.loop,
+                    ssl=self.ssl_context(), server_hostname=self.hostname, **address)
+        except OSError:
+            if self.pool:
+                self.pool.connect_failed(self)
+            raise
+
+        if self.ssl and self.pool:
+            self.pool.handshake_done(self)
+
+    async def address(self):
+        """
+        Return the keyword arguments for opening a socket to the server: a
+        socket already connected by the pool if it races the server's
+        addresses, otherwise the host and port.
+        """
+        if self.pool and self.pool.happy_eyeballs:
+            return { 'sock': await self.pool.open_socket(self) }
+
+        return { 'host': self.host, 'port': self.port }
+
+    def ssl_context(self):
+        """
+        Return the ``ssl`` argument for opening a socket, which offers a cached
+        TLS session for resumption if the pool has one.
+        """
+        if self.ssl and self.pool:
+            return self.pool.ssl_context(self)
+
+        return self.ssl
+
+    def ssl_object(self):
+        """
+        Return the :class:`ssl.SSLObject` of the socket, if any.
+        """
+        if self.writer:
+            return self.writer.get_extra_info('ssl_object')
 
     async def read(self, num_bytes):
         """
@@ -61,21 +135,55 @@ class Connection:
 
         return data
 
-    async def send(self, message):
+    async def receive(self, request):
+        """
+        Feed data from the socket into the parser of ``request`` until the
+        request no longer needs data. Returns False if the connection was
+        closed first.
+        """
+        while request.waiting:
+            data = await self.read(65535)
+            if not data:
+                return False
+
+            request.parser.feed_data(data)
+
+        return True
+
+    async def send(self, message, request=None):
         """
         Write up to num_bytes off of the socket.
+
+        ``request`` is the :class:`uvhttp.http.HTTPRequest` being sent, if any.
         """
         if not self.writer:
             await self.connect()
 
         self.writer.write(message)
 
+    def acquire(self):
+        """
+        Called by the pool to lock the connection for a request.
+        """
+        self.locked = True
+        self.requests += 1
+
+        if self.subpool:
+            self.subpool.outstanding += 1
+
     def release(self):
         """
         Called once the connection is no longer needed to release back into
         the pool.
         """
         self.locked = False
+
+        if self.subpool:
+            self.subpool.outstanding -= 1
+
+        if self.pool:
+            self.pool.release(self)
+
         self.pool_available.release()
 
     def close(self):
@@ -84,9 +192,820 @@ class Connection:
         is retrieved from the pool and used.
         """
         if self.writer:
+            if self.ssl and self.pool:
+                self.pool.save_tls_session(self)
+
             self.writer.close()
         self.writer = None
         self.reader = None
+        self.requests = 0
+
+        if self.pool and not self.locked:
+            self.pool.discard(self)
+
+# TLS sessions can only be resumed on Python 3.6 and later.
+TLS_SESSIONS = hasattr(ssl, 'SSLSession')
+
+class SessionContext:
+    """
+    Wraps an :class:`ssl.SSLContext` so that the socket it creates offers
+    ``session`` to the server for resumption.
+    """
+    def __init__(self, context, session):
+        self.context = context
+        self.session = session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return self.context.wrap_bio(incoming, outgoing, server_side=server_side,
+                server_hostname=server_hostname, session=session or self.session)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+if hasattr(asyncio, 'BufferedProtocol'):
+    BaseProtocol = asyncio.BufferedProtocol
+else:
+    BaseProtocol = asyncio.Protocol
+
+class HTTPProtocol(BaseProtocol):
+    """
+    An asyncio protocol that feeds received data straight into the parser of
+    the request currently waiting on the connection, skipping the buffering
+    done by :class:`asyncio.StreamReader`. Data is received into a reused
+    buffer when the event loop supports :class:`asyncio.BufferedProtocol`.
+    """
+    def __init__(self, loop, buffer_size=65536):
+        self.loop = loop
+
+        self.transport = None
+        self.closed = False
+        self.paused = False
+
+        # The request being fed and a future resolved once it stops waiting.
+        self.request = None
+        self.waiter = None
+
+        # Data received while no request is waiting.
+        self.pending = collections.deque()
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.wakeup(False)
+
+    def eof_received(self):
+        return False
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        self.data_received(self.view[:nbytes])
+
+    def data_received(self, data):
+        request = self.request
+
+        if request is None:
+            self.pending.append(bytes(data))
+            self.wakeup(True)
+            return
+
+        try:
+            request.parser.feed_data(data)
+        except Exception as e:
+            if self.waiter and not self.waiter.done():
+                self.waiter.set_exception(e)
+            return
+
+        if not request.waiting:
+            self.request = None
+
+            # Apply backpressure to a streaming body until it is consumed.
+            if not request.body_done:
+                self.pause()
+
+            self.wakeup(True)
+
+    def wakeup(self, result):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(result)
+
+    def pause(self):
+        if not self.paused and not self.closed:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def resume(self):
+        if self.paused and not self.closed:
+            self.paused = False
+            self.transport.resume_reading()
+
+    async def wait(self):
+        self.resume()
+
+        self.waiter = self.loop.create_future()
+        try:
+            return await self.waiter
+        finally:
+            self.waiter = None
+
+    async def receive(self, request):
+        """
+        Feed received data into the parser of ``request`` until it no longer
+        needs data. Returns False if the connection was closed first.
+        """
+        while self.pending and request.waiting:
+            request.parser.feed_data(self.pending.popleft())
+
+        if not request.waiting:
+            return True
+
+        if self.closed:
+            return False
+
+        self.request = request
+        try:
+            return await self.wait()
+        finally:
+            self.request = None
+
+    async def read(self):
+        """
+        Return the next piece of data received, or ``b''`` once the connection
+        has been closed.
+        """
+        while not self.pending:
+            if self.closed:
+                return b''
+
+            await self.wait()
+
+        return self.pending.popleft()
+
+class ProtocolConnection(Connection):
+    """
+    A :class:`.Connection` that uses :class:`.HTTPProtocol` instead of
+    streams, see :class:`.Pool`.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.transport = None
+        self.protocol = None
+
+    @property
+    def connected(self):
+        """
+        Return true if the socket is open.
+        """
+        return self.protocol is not None and not self.protocol.closed
+
+    async def connect(self):
+        """
+        Open a new connection to the server. Should only be called when the
+        connection has not established yet or we disconnected.
+        """
+        address = await self.address()
+
+        self.connect_count += 1
+        self.connected_at = self.loop.time()
+        try:
+            self.transport, self.protocol = await self.loop.create_connection(
+                    self.create_protocol, ssl=self.ssl_context(),
+                    server_hostname=self.hostname, **address)
+        except OSError:
+            if self.pool:
+                self.pool.connect_failed(self)
+            raise
+
+        if self.ssl and self.pool:
+            self.pool.handshake_done(self)
+
+    def ssl_object(self):
+        """
+        Return the :class:`ssl.SSLObject` of the socket, if any.
+        """
+        if self.transport:
+            return self.transport.get_extra_info('ssl_object')
+
+    def create_protocol(self):
+        return HTTPProtocol(self.loop)
+
+    async def read(self, num_bytes):
+        """
+        Read the next piece of data off of the socket.
+        """
+        if not self.protocol:
+            await self.connect()
+
+        data = await self.protocol.read()
+        if not data:
+            self.close()
+
+        return data
+
+    async def receive(self, request):
+        """
+        Feed data from the socket into the parser of ``request`` until the
+        request no longer needs data. Returns False if the connection was
+        closed first.
+        """
+        if not self.protocol:
+            return False
+
+        if not await self.protocol.receive(request):
+            self.close()
+            return False
+
+        return True
+
+    async def send(self, message, request=None):
+        """
+        Write ``message`` to the socket.
+        """
+        if not self.protocol or self.protocol.closed:
+            await self.connect()
+
+        self.transport.write(message)
+
+    def close(self):
+        """
+        Close a connection (will trigger a reconnect next time the Connection)
+        is retrieved from the pool and used.
+        """
+        if self.transport:
+            if self.ssl and self.pool:
+                self.pool.save_tls_session(self)
+
+            self.transport.close()
+        self.transport = None
+        self.protocol = None
+        self.requests = 0
+
+        if self.pool and not self.locked:
+            self.pool.discard(self)
+
+# Requests that may be pipelined behind other requests.
+PIPELINE_METHODS = frozenset([ b'GET', b'PUT', b'DELETE', b'OPTIONS', b'TRACE' ])
+
+# Requests that are safe to send again if the connection closes before their
+# response begins.
+REPLAY_METHODS = PIPELINE_METHODS | frozenset([ b'HEAD' ])
+
+class PipelineProtocol(HTTPProtocol):
+    """
+    An :class:`.HTTPProtocol` that hands all data to a
+    :class:`.PipelinedConnection`.
+    """
+    def __init__(self, loop, connection):
+        super().__init__(loop)
+        self.connection = connection
+
+    def data_received(self, data):
+        self.connection.feed_data(self, data)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.connection.connection_lost(self)
+
+class PipelinedRequest:
+    """
+    A request in flight on a :class:`.PipelinedConnection`.
+    """
+    def __init__(self, request, message):
+        self.request = request
+        self.message = message
+
+        # Number of times the request was sent again after a disconnect.
+        self.replays = 0
+
+        # None while in flight, then True, False (closed) or an exception.
+        self.result = None
+        self.waiter = None
+
+        # Set when the request was closed before its response was read, the
+        # response is then read and thrown away.
+        self.discarded = False
+
+class PipelinedConnection(ProtocolConnection):
+    """
+    A :class:`.ProtocolConnection` that allows up to ``depth`` requests to be
+    in flight at once using HTTP/1.1 pipelining. Responses are matched to
+    requests in the order they were sent and requests sent in the same loop
+    iteration are written to the socket together.
+
+    Only idempotent requests (see ``PIPELINE_METHODS``) are pipelined, any
+    other request (and any streaming request) waits for the connection to be
+    drained and has it to itself until its response is done.
+
+    If the connection closes, requests whose responses had not started yet are
+    sent again on a new connection if they are idempotent.
+    """
+    max_replays = 3
+
+    def __init__(self, *args, depth=2, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.depth = depth
+        self.outstanding = 0
+
+        self.parser = None
+
+        # Requests in the order they were sent, and whether the response to
+        # the first one has started.
+        self.inflight = collections.deque()
+        self.started = False
+        self.pending = {}
+
+        # A request that must have the connection to itself.
+        self.barrier = None
+        self.drained = asyncio.Event(loop=self.loop)
+        self.drained.set()
+
+        # Messages waiting to be written at the end of this loop iteration.
+        self.outgoing = []
+        self.flush_scheduled = False
+
+        # Set when a response asks for the connection to be closed.
+        self.draining = False
+
+        self.connect_lock = asyncio.Lock(loop=self.loop)
+
+    def create_protocol(self):
+        return PipelineProtocol(self.loop, self)
+
+    async def connect(self):
+        """
+        Open a new connection to the server. Should only be called when the
+        connection has not established yet or we disconnected.
+        """
+        await super().connect()
+
+        self.parser = HttpResponseParser(self)
+        self.started = False
+
+    @property
+    def idle(self):
+        """
+        Return true if no requests are using the connection.
+        """
+        return not self.outstanding
+
+    def acquire(self):
+        """
+        Called by the pool to reserve a slot on the connection for a request.
+        """
+        self.outstanding += 1
+        self.locked = self.outstanding >= self.depth
+        self.requests += 1
+
+        if self.subpool:
+            self.subpool.outstanding += 1
+
+    def release(self):
+        """
+        Called once a request is done with the connection.
+        """
+        self.outstanding -= 1
+        self.locked = self.outstanding >= self.depth
+
+        if self.subpool:
+            self.subpool.outstanding -= 1
+
+        if self.pool and not self.outstanding:
+            self.pool.release(self)
+
+        self.pool_available.release()
+
+    async def send(self, message, request=None):
+        """
+        Queue ``message`` to be written to the socket. ``request`` is required
+        so that its response can be matched up to it.
+        """
+        entry = PipelinedRequest(request, message)
+
+        while self.barrier:
+            await self.wait_drained()
+
+        if request.stream or request.method not in PIPELINE_METHODS:
+            self.barrier = entry
+
+            try:
+                while self.inflight:
+                    await self.wait_drained()
+            except:
+                self.barrier = None
+                self.drained.set()
+                raise
+
+        self.pending[request] = entry
+        self.inflight.append(entry)
+        self.outgoing.append(message)
+
+        async with self.connect_lock:
+            if entry.result is None and not self.protocol:
+                try:
+                    await self.connect()
+                except Exception as e:
+                    self.fail(e)
+
+        if isinstance(entry.result, Exception):
+            del self.pending[request]
+            raise entry.result
+
+        self.schedule_flush()
+
+    async def wait_drained(self):
+        self.drained.clear()
+        await self.drained.wait()
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        Write all queued messages to the socket in a single call.
+        """
+        self.flush_scheduled = False
+
+        if not self.outgoing or not self.transport:
+            return
+
+        if len(self.outgoing) == 1:
+            data = self.outgoing[0]
+        else:
+            data = b''.join(self.outgoing)
+
+        self.outgoing = []
+        self.transport.write(data)
+
+    async def receive(self, request):
+        """
+        Wait for the response to ``request``, which is fed to it as it is
+        received. Returns False if the connection was closed first.
+        """
+        entry = self.pending.get(request)
+        if entry is None:
+            return not request.waiting
+
+        if entry.result is None and request.waiting:
+            entry.waiter = self.loop.create_future()
+
+            if self.protocol:
+                self.protocol.resume()
+
+            try:
+                await entry.waiter
+            finally:
+                entry.waiter = None
+
+        # A streaming response with more of the body to come.
+        if entry.result is None:
+            return True
+
+        del self.pending[request]
+
+        if isinstance(entry.result, Exception):
+            raise entry.result
+
+        return entry.result
+
+    def finish(self, entry, result):
+        entry.result = result
+
+        if entry is self.barrier:
+            self.barrier = None
+
+        if entry.waiter and not entry.waiter.done():
+            entry.waiter.set_result(None)
+
+    def fail(self, result):
+        """
+        Fail all of the requests in flight with ``result``.
+        """
+        for entry in self.inflight:
+            self.finish(entry, result)
+
+        self.inflight.clear()
+        self.outgoing = []
+        self.drained.set()
+
+    def feed_data(self, protocol, data):
+        if protocol is not self.protocol:
+            return
+
+        try:
+            self.parser.feed_data(data)
+        except Exception as e:
+            self.drop(e)
+            return
+
+        if self.draining:
+            self.drop()
+            return
+
+        # Wake up a streaming request once it has data to consume and stop
+        # reading until it has been consumed.
+        if self.inflight:
+            entry = self.inflight[0]
+
+            if entry.request.stream and not entry.request.waiting \
+              and entry.waiter and not entry.waiter.done():
+                self.protocol.pause()
+                entry.waiter.set_result(None)
+
+    def connection_lost(self, protocol):
+        if protocol is self.protocol:
+            self.drop()
+
+    def drop(self, error=None):
+        """
+        Close the socket and send any requests whose responses had not started
+        again on a new one.
+        """
+        if self.transport:
+            self.transport.close()
+
+        self.transport = None
+        self.protocol = None
+        self.parser = None
+        self.draining = False
+
+        entries = list(self.inflight)
+        self.inflight.clear()
+        self.outgoing = []
+
+        if entries and (self.started or error):
+            self.finish(entries.pop(0), error or False)
+
+        self.started = False
+
+        for entry in entries:
+            if entry.discarded:
+                self.finish(entry, False)
+            elif entry.request.method in REPLAY_METHODS and entry.replays < self.max_replays:
+                entry.replays += 1
+                self.inflight.append(entry)
+                self.outgoing.append(entry.message)
+            else:
+                self.finish(entry, False)
+
+        if self.inflight:
+            asyncio.ensure_future(self.replay(), loop=self.loop)
+        else:
+            self.drained.set()
+
+    async def replay(self):
+        async with self.connect_lock:
+            if not self.protocol:
+                try:
+                    await self.connect()
+                except Exception as e:
+                    self.fail(e)
+                    return
+
+        self.schedule_flush()
+
+    def close(self):
+        """
+        Close the connection if no requests are in flight or if the request
+        whose response is being received was closed before it was done.
+        Requests still in flight are replayed as if the server had closed
+        the connection. Responses to other requests that were closed are
+        discarded when they arrive.
+        """
+        for request in [ request for request in self.pending if request.closed ]:
+            self.pending.pop(request).discarded = True
+
+        if not self.inflight:
+            super().close()
+        elif self.inflight[0].request.closed:
+            self.drop()
+
+    def complete(self, entry):
+        self.inflight.popleft()
+        self.started = False
+
+        # The parser may still expect a body for a HEAD request, so barrier
+        # requests get a fresh parser.
+        if entry is self.barrier:
+            self.parser = HttpResponseParser(self)
+
+        if not entry.request.keep_alive:
+            self.draining = True
+
+        self.finish(entry, True)
+
+        if not self.inflight:
+            self.drained.set()
+
+    def on_message_begin(self):
+        if self.inflight:
+            self.started = True
+            self.inflight[0].request.on_message_begin()
+
+    def on_header(self, name, value):
+        if self.inflight:
+            self.inflight[0].request.on_header(name, value)
+
+    def on_headers_complete(self):
+        if not self.inflight:
+            return
+
+        entry = self.inflight[0]
+        entry.request.parser = self.parser
+        entry.request.on_headers_complete()
+
+        if entry.request.body_done:
+            self.complete(entry)
+
+    def on_body(self, body):
+        if self.inflight and not self.inflight[0].discarded:
+            self.inflight[0].request.on_body(body)
+
+    def on_chunk_complete(self):
+        if self.inflight:
+            self.inflight[0].request.on_chunk_complete()
+
+    def on_message_complete(self):
+        if not self.inflight:
+            return
+
+        entry = self.inflight[0]
+        entry.request.on_message_complete()
+        self.complete(entry)
+
+# Seconds to avoid an address for after failing to connect to it.
+FAILED_ADDRESS_TIMEOUT = 5
+
+class SubPool:
+    """
+    The connections of a :class:`.Pool` to one of its host's addresses, used
+    when the pool balances requests across addresses.
+    """
+    def __init__(self, address):
+        self.address = address
+
+        self.connections = []
+        self.idle = collections.deque()
+
+        # Requests in flight on the connections.
+        self.outstanding = 0
+
+        # When a connection to the address last failed.
+        self.failed_at = None
+
+        # True once the address is no longer resolved, its connections are
+        # closed as they are released.
+        self.draining = False
+
+class PrioritySemaphore:
+    """
+    A semaphore that wakes waiters in priority order (lower numbers first)
+    and in the order they arrived within a priority, used by :class:`.Pool`
+    to hand out connections.
+
+    If ``aging`` is set, a waiter is treated as one priority level more urgent
+    for every ``aging`` seconds it has waited, so that low priority waiters
+    are not starved.
+
+    Waiters with a ``deadline`` (in loop time) are shed with
+    :class:`asyncio.TimeoutError` once it passes.
+    """
+    def __init__(self, value, loop, aging=None):
+        self.value = value
+        self.loop = loop
+        self.aging = aging
+
+        # Heap of (rank, sequence, priority, enqueued, future).
+        self.waiters = []
+        self.sequence = itertools.count()
+
+        # Waiters, acquisitions and wait times by priority, see stats().
+        self.waiting = collections.Counter()
+        self.served = collections.Counter()
+        self.shed = collections.Counter()
+        self.wait_total = collections.Counter()
+        self.wait_max = {}
+
+    def locked(self):
+        """
+        Return true if acquire() would wait.
+        """
+        return self.value == 0
+
+    async def acquire(self, priority=0, deadline=None):
+        """
+        Wait until the semaphore can be acquired at ``priority``, or raise
+        :class:`asyncio.TimeoutError` if ``deadline`` passes first.
+        """
+        if deadline is not None and self.loop.time() >= deadline:
+            self.shed[priority] += 1
+            raise asyncio.TimeoutError()
+
+        if self.value > 0:
+            # Waiters are only queued while the value is zero.
+            self.value -= 1
+            self.served[priority] += 1
+            return True
+
+        enqueued = self.loop.time()
+
+        # Aging a waiter by the time it waited and comparing against another
+        # waiter at the same time cancels out the current time, so the order
+        # of waiters never changes and a heap can be used.
+        if self.aging:
+            rank = priority + enqueued / self.aging
+        else:
+            rank = priority
+
+        future = self.loop.create_future()
+        heapq.heappush(self.waiters, (rank, next(self.sequence), priority, enqueued, future))
+        self.waiting[priority] += 1
+
+        if deadline is not None:
+            timer = self.loop.call_at(deadline, expire, future)
+
+        try:
+            await future
+        except asyncio.TimeoutError:
+            # Left in the heap and skipped by release().
+            self.waiting[priority] -= 1
+            self.shed[priority] += 1
+            raise
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.waiting[priority] -= 1
+            else:
+                # The semaphore was handed over as the wait was cancelled.
+                self.release()
+            raise
+        finally:
+            if deadline is not None:
+                timer.cancel()
+
+        return True
+
+    def release(self):
+        """
+        Release the semaphore, handing it to the most urgent waiter.
+        """
+        while self.waiters:
+            _, _, priority, enqueued, future = heapq.heappop(self.waiters)
+
+            # Cancelled or shed.
+            if future.done():
+                continue
+
+            waited = self.loop.time() - enqueued
+
+            self.waiting[priority] -= 1
+            self.served[priority] += 1
+            self.wait_total[priority] += waited
+            self.wait_max[priority] = max(self.wait_max.get(priority, 0), waited)
+
+            future.set_result(True)
+            return
+
+        self.value += 1
+
+    def stats(self):
+        """
+        Return the number of waiters, acquisitions, waiters shed by their
+        deadline and the average and longest wait (in seconds) for each
+        priority.
+        """
+        return {
+            priority: {
+                'waiting': self.waiting[priority],
+                'served': self.served[priority],
+                'shed': self.shed[priority],
+                'wait_avg': self.wait_total[priority] / max(self.served[priority], 1),
+                'wait_max': self.wait_max.get(priority, 0),
+            } for priority in set(self.waiting) | set(self.served) | set(self.shed)
+        }
+
+def expire(future):
+    """
+    Timer callback that fails a waiter whose deadline passed.
+    """
+    if not future.done():
+        future.set_exception(asyncio.TimeoutError())
+
+def close_socket(attempt):
+    """
+    Done callback that closes the socket of a connection attempt that lost the
+    race but connected anyway.
+    """
+    if not attempt.cancelled() and not attempt.exception():
+        attempt.result().close()
 
 class Pool:
     """
@@ -96,9 +1015,69 @@ class Pool:
     A :class:`uvhttp.dns.Resolver` can be passed or one will be created.
 
     A :class:`ssl.SSLContext` can also be passed or SSL will not be used.
+
+    If ``protocol`` is true, connections use :class:`.ProtocolConnection`,
+    which feeds the response parser directly from the transport.
+
+    If ``pipeline`` is greater than one, connections use
+    :class:`.PipelinedConnection` and up to ``pipeline`` idempotent requests
+    are sent on each connection without waiting for responses.
+
+    Idle connections are reused before new ones are opened. If ``reuse`` is
+    ``'lifo'`` the most recently released connection is reused first, which
+    keeps a small set of connections warm. If it is ``'fifo'`` the least
+    recently released connection is reused first, which spreads requests
+    evenly across all connections.
+
+    Connections are closed once they have been idle for ``idle_timeout``
+    seconds, open for ``max_lifetime`` seconds or used for ``max_requests``
+    requests, so that a stale socket is not reused after the server (or a load
+    balancer) silently dropped it. A background task checks idle connections
+    and, if ``replace_reaped`` is true, opens a new socket in place of each one
+    it closes. The number of connections closed shows up in :meth:`.stats`.
+
+    Unless ``tls_sessions`` is false, the TLS session of each server the pool
+    connects to is cached and offered when a new connection is opened to it,
+    so that the server can resume it instead of doing a full handshake. The
+    ``tls_resumed`` and ``tls_full_handshakes`` counters in :meth:`.stats`
+    show how often this works.
+
+    Waiting callers of :meth:`.connect` are served by ``priority`` (lower
+    numbers first) and in arrival order within a priority. A waiter moves up
+    one priority level for every ``priority_aging`` seconds it waits, so that
+    background requests still make progress while urgent ones arrive.
+
+    When the host is a name rather than an IP, each new connection races all
+    of its resolved addresses (Happy Eyeballs, RFC 8305): IPv6 and IPv4
+    addresses are tried alternately, starting another attempt every
+    ``happy_eyeballs_delay`` seconds or as soon as one fails, and the first to
+    connect is used. Addresses that connected quickly before are tried first
+    next time, and the ``connected_ipv6`` and ``connected_ipv4`` counters in
+    :meth:`.stats` show which family won. Set ``happy_eyeballs_delay`` to
+    ``None`` to connect to a single resolved address instead.
+
+    If ``balance`` is set, the pool keeps a :class:`.SubPool` of connections
+    for each of the host's addresses instead, and sends each request to the
+    address with the fewest requests in flight (``'least_outstanding'``) or
+    to the less busy of two random addresses (``'power_of_two'``).
+    Addresses that recently failed to connect are avoided. When the resolved
+    addresses change, connections to addresses that are gone are closed once
+    they are released.
     """
-    def __init__(self, host, port, conn_limit, loop, resolver=None, ipv6=True, ssl=None):
+    def __init__(self, host, port, conn_limit, loop, resolver=None, ipv6=True, ssl=None,
+                 protocol=False, pipeline=1, reuse='lifo', idle_timeout=None, max_lifetime=None,
+                 max_requests=None, replace_reaped=False, tls_sessions=True,
+                 happy_eyeballs_delay=0.25, balance=None, priority_aging=1):
         self.conn_limit = conn_limit
+        self.pipeline = pipeline
+
+        if reuse not in ('lifo', 'fifo'):
+            raise ValueError('reuse must be lifo or fifo')
+
+        self.lifo = reuse == 'lifo'
+
+        if balance not in (None, 'least_outstanding', 'power_of_two'):
+            raise ValueError('balance must be least_outstanding or power_of_two')
 
         self.host = host
         self.port = port
@@ -106,50 +1085,673 @@ class Pool:
         self.loop = loop
 
         self.pool = []
-        self.pool_available = asyncio.Semaphore(self.conn_limit, loop=loop)
+
+        # Connections that are not locked, in the order they were released.
+        self.idle = collections.deque()
+
+        self.pool_available = PrioritySemaphore(self.conn_limit * self.pipeline, loop,
+                aging=priority_aging)
         self.pool_lock = asyncio.Lock(loop=loop)
 
         self.resolver = resolver or uvhttp.dns.Resolver(loop, ipv6=ipv6)
         self.use_resolver = not uvhttp.utils.is_ip(host)
 
+        # Balancing pins each connection to an address, so it replaces racing.
+        self.balance = balance if self.use_resolver else None
+
+        # SubPools by address and the addresses last resolved, in order.
+        self.subpools = {}
+        self.addresses = []
+
+        # Reconnects made by connections that were removed from the pool.
+        self.retired_connects = 0
+
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.happy_eyeballs = self.use_resolver and happy_eyeballs_delay is not None \
+            and not self.balance
+
+        # How long the last successful connection to each address took, or
+        # None if the last attempt failed. Used to order addresses.
+        self.connect_times = {}
+
         self.ssl = ssl
 
-    async def connect(self):
+        # TLS sessions by server address.
+        self.tls_sessions = {} if tls_sessions and TLS_SESSIONS else None
+
+        if self.pipeline > 1:
+            self.connection_cls = functools.partial(PipelinedConnection, depth=self.pipeline)
+        elif protocol:
+            self.connection_cls = ProtocolConnection
+        else:
+            self.connection_cls = Connection
+
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.max_requests = max_requests
+        self.replace_reaped = replace_reaped
+
+        # Check idle connections twice per timeout.
+        timeouts = [ t for t in (idle_timeout, max_lifetime) if t ]
+        if timeouts:
+            self.reap_interval = min(timeouts) / 2
+        else:
+            self.reap_interval = None
+
+        self.reaper = None
+
+        # Counters for events in the pool, see stats().
+        self.counters = collections.Counter()
+
+    async def connect(self, priority=0, deadline=None, fresh=False, connect_timeout=None):
         """
         Waits for an available connection and then returns a connection object
-        ready to use.
+        ready to use. Callers with a lower ``priority`` are served first.
+
+        If ``deadline`` (in loop time) passes while waiting,
+        :class:`asyncio.TimeoutError` is raised without using a connection.
+
+        If ``fresh`` is true, an idle connection that is open is closed so
+        that it reconnects, for example to retry a request that failed on a
+        socket the server had closed while it was idle.
+
+        ``connect_timeout`` limits resolving the host once a connection is
+        available.
         """
-        await self.pool_available.acquire()
+        await self.pool_available.acquire(priority, deadline)
+
+        resolve_deadline = deadline
+        if connect_timeout is not None:
+            resolve_deadline = self.loop.time() + connect_timeout
+            if deadline is not None:
+                resolve_deadline = min(resolve_deadline, deadline)
+
+        try:
+            if self.balance:
+                c = self.connect_balanced()
+            else:
+                c = self.connect_unbalanced()
+
+            # Resolving the host may still take a while.
+            c = await uvhttp.utils.wait_for(c, resolve_deadline, self.loop)
+        except:
+            self.pool_available.release()
+            raise
+
+        if fresh and c.connected and c.idle:
+            c.close()
+
+        c.acquire()
+
+        if self.reap_interval and not self.reaper:
+            self.reaper = asyncio.ensure_future(self.reap_forever(), loop=self.loop)
 
-        c = None
+        return c
 
-        if len(self.pool) < self.conn_limit:
-            if self.use_resolver:
+    async def connect_unbalanced(self):
+        """
+        Return an idle connection, or a new one if the pool is not full.
+        """
+        if self.idle:
+            if self.lifo:
+                c = self.idle.pop()
+            else:
+                c = self.idle.popleft()
+        elif len(self.pool) < self.conn_limit:
+            if self.happy_eyeballs:
+                # The address is picked when connecting, but resolve now so
+                # that DNS errors are raised here.
+                addresses = await self.resolver.resolve_all(self.host, self.port)
+                host, port, ttl = self.sort_addresses(addresses)[0]
+            elif self.use_resolver:
                 host, port, ttl = await self.resolver.resolve(self.host, self.port)
             else:
                 host, port = self.host, self.port
 
-            c = Connection(host, port, self.pool_available, self.loop, ssl=self.ssl, hostname=self.host)
-            c.locked = True
+            c = self.connection_cls(host, port, self.pool_available, self.loop, ssl=self.ssl,
+                    hostname=self.host, pool=self)
             self.pool.append(c)
         else:
-            for i, connection in enumerate(self.pool):
-                if not connection.locked:
-                    connection.locked = True
-                    c = connection
-                    break
+            # Pipelined connections are shared, so use the least busy one.
+            c = min(self.pool, key=lambda connection: connection.outstanding)
+
+        return c
+
+    async def connect_balanced(self):
+        """
+        Return a connection to the address picked by the ``balance`` policy,
+        reusing an idle one if possible.
+        """
+        subpool = await self.choose_subpool()
+
+        if subpool.idle:
+            if self.lifo:
+                c = subpool.idle.pop()
+            else:
+                c = subpool.idle.popleft()
+        elif len(self.pool) < self.conn_limit:
+            host, port = subpool.address
+            c = self.connection_cls(host, port, self.pool_available, self.loop, ssl=self.ssl,
+                    hostname=self.host, pool=self)
+            c.subpool = subpool
+            subpool.connections.append(c)
+            self.pool.append(c)
+        elif self.pipeline > 1:
+            c = min(subpool.connections or self.pool,
+                    key=lambda connection: connection.outstanding)
+        else:
+            c = self.move_idle(subpool)
+
+        return c
+
+    async def choose_subpool(self):
+        """
+        Resolve the host, update the SubPools if its addresses changed and
+        pick one according to the ``balance`` policy.
+        """
+        addresses = await self.resolver.resolve_all(self.host, self.port)
+        addresses = [ (ip, port) for ip, port, expires in addresses ]
+
+        if addresses != self.addresses:
+            self.update_addresses(addresses)
+
+        subpools = [ self.subpools[address] for address in addresses ]
+
+        now = self.loop.time()
+        candidates = [ s for s in subpools
+                       if not s.failed_at or now - s.failed_at > FAILED_ADDRESS_TIMEOUT ]
+        candidates = candidates or subpools
+
+        if self.balance == 'power_of_two' and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+
+        # Ties go to the address with an idle connection, then to the
+        # resolver's order.
+        return min(candidates, key=lambda s: (s.outstanding, not s.idle))
+
+    def update_addresses(self, addresses):
+        """
+        Create SubPools for new addresses and drain the SubPools of addresses
+        that are gone.
+        """
+        for address in addresses:
+            if address in self.subpools:
+                self.subpools[address].draining = False
+            else:
+                self.subpools[address] = SubPool(address)
+
+        for address, subpool in list(self.subpools.items()):
+            if address in addresses or subpool.draining:
+                continue
+
+            subpool.draining = True
+            self.counters['drained_addresses'] += 1
+
+            while subpool.idle:
+                self.retire(subpool.idle.popleft())
+
+            if not subpool.connections:
+                self.subpools.pop(address, None)
+
+        self.addresses = addresses
+
+    def move_idle(self, subpool):
+        """
+        Move an idle connection from the SubPool with the most idle
+        connections to ``subpool``, closing it so that it reconnects to the
+        new address.
+        """
+        donor = max([ s for s in self.subpools.values() if s.idle ],
+                    key=lambda s: len(s.idle))
+
+        # Take the connection that would be reused last.
+        if self.lifo:
+            c = donor.idle.popleft()
+        else:
+            c = donor.idle.pop()
+
+        c.close()
+        donor.connections.remove(c)
+
+        c.host, c.port = subpool.address
+        c.subpool = subpool
+        subpool.connections.append(c)
 
+        self.counters['rebalanced'] += 1
         return c
 
-    async def stats(self):
+    def retire(self, connection):
+        """
+        Close a connection to an address that is no longer resolved and
+        remove it from the pool.
+        """
+        subpool = connection.subpool
+
+        connection.close()
+        self.retired_connects += connection.connect_count
+
+        self.pool.remove(connection)
+        subpool.connections.remove(connection)
+        self.counters['retired'] += 1
+
+        if subpool.draining and not subpool.connections:
+            del self.subpools[subpool.address]
+
+    def connect_failed(self, connection):
+        """
+        Note that ``connection`` could not connect to its address.
+        """
+        if connection.subpool:
+            connection.subpool.failed_at = self.loop.time()
+            self.counters['connect_failed'] += 1
+
+    def idle_list(self, connection):
+        """
+        Return the idle list ``connection`` belongs in.
+        """
+        if connection.subpool:
+            return connection.subpool.idle
+
+        return self.idle
+
+    def release(self, connection):
+        """
+        Add a connection that is no longer locked to the idle list, closing it
+        first if it has expired.
+        """
+        connection.last_used = self.loop.time()
+
+        if connection.subpool and connection.subpool.draining:
+            self.retire(connection)
+            return
+
+        if self.pipeline == 1:
+            idle = self.idle_list(connection)
+
+            # A closed connection goes to the end that is reused last, so
+            # that open connections are preferred (see discard()).
+            if connection.connected or not self.lifo:
+                idle.append(connection)
+            else:
+                idle.appendleft(connection)
+
+        if connection.connected:
+            # Save the TLS session after a response has been read, as TLS 1.3
+            # servers send session tickets after the handshake.
+            if connection.ssl:
+                self.save_tls_session(connection)
+
+            reason = self.expired(connection, connection.last_used)
+            if reason:
+                self.reap(connection, reason)
+
+    def discard(self, connection):
+        """
+        Move an idle connection that was closed to the end of the idle list
+        that is reused last, so that open connections are preferred.
+        """
+        idle = self.idle_list(connection)
+
+        try:
+            idle.remove(connection)
+        except ValueError:
+            return
+
+        if self.lifo:
+            idle.appendleft(connection)
+        else:
+            idle.append(connection)
+
+    async def warmup(self, connections):
+        """
+        Resolve the host and open up to ``connections`` connections in the
+        pool concurrently. Connections that are already open count towards
+        the total. Returns a dictionary of timing statistics (in seconds)::
+
+            {
+                'opened': 4,            # new connections opened
+                'open': 1,              # connections that were already open
+                'failed': 0,            # connections that could not be opened
+                'resolve': 0.002,       # DNS resolution
+                'connect_min': 0.010,   # fastest connection (including TLS)
+                'connect_max': 0.021,   # slowest connection
+                'connect_avg': 0.015,
+                'total': 0.024,
+            }
+        """
+        start = time.monotonic()
+
+        stats = {
+            'opened': 0,
+            'open': 0,
+            'failed': 0,
+            'resolve': 0,
+            'connect_min': 0,
+            'connect_max': 0,
+            'connect_avg': 0,
+        }
+
+        if self.use_resolver:
+            await self.resolver.resolve(self.host, self.port)
+            stats['resolve'] = time.monotonic() - start
+
+        conns = []
+        for _ in range(min(connections, self.conn_limit)):
+            conns.append(await self.connect())
+
+        async def open_connection(connection):
+            if connection.connected:
+                return
+
+            connect_start = time.monotonic()
+            await connection.connect()
+            return time.monotonic() - connect_start
+
+        try:
+            results = await asyncio.gather(*[ open_connection(c) for c in conns ],
+                    loop=self.loop, return_exceptions=True)
+        finally:
+            for connection in conns:
+                # Warming up a connection does not count as a request.
+                connection.requests -= 1
+                connection.release()
+
+        times = []
+        for result in results:
+            if result is None:
+                stats['open'] += 1
+            elif isinstance(result, Exception):
+                stats['failed'] += 1
+            else:
+                stats['opened'] += 1
+                times.append(result)
+
+        if times:
+            stats['connect_min'] = min(times)
+            stats['connect_max'] = max(times)
+            stats['connect_avg'] = sum(times) / len(times)
+
+        stats['total'] = time.monotonic() - start
+        return stats
+
+    def sort_addresses(self, addresses):
+        """
+        Order resolved addresses for racing: addresses that connected before
+        (fastest first), then untried addresses, then addresses that failed.
+        The resolver's order is kept otherwise.
+        """
+        def rank(address):
+            if address[0] not in self.connect_times:
+                return (1, 0)
+
+            elapsed = self.connect_times[address[0]]
+            if elapsed is None:
+                return (2, 0)
+
+            return (0, elapsed)
+
+        return sorted(addresses, key=rank)
+
+    async def open_socket(self, connection):
+        """
+        Resolve the host and race connections to its addresses, returning the
+        socket of the first one to connect. The address is recorded on
+        ``connection``.
+        """
+        addresses = await self.resolver.resolve_all(self.host, self.port)
+        addresses = [ (ip, port) for ip, port, expires in self.sort_addresses(addresses) ]
+
+        start = time.monotonic()
+        sock, address = await self.race(addresses)
+
+        self.connect_times[address[0]] = time.monotonic() - start
+        if uvhttp.dns.is_ipv6(address[0]):
+            self.counters['connected_ipv6'] += 1
+        else:
+            self.counters['connected_ipv4'] += 1
+
+        connection.host, connection.port = address
+        return sock
+
+    async def race(self, addresses):
+        """
+        Connect to ``addresses`` in order, starting the next attempt once
+        ``happy_eyeballs_delay`` seconds pass or an attempt fails. Returns the
+        first socket to connect and its address, or raises the last error if
+        none do.
+        """
+        addresses = collections.deque(addresses)
+        attempts = {}
+        error = None
+
+        try:
+            while addresses or attempts:
+                timeout = None
+                if addresses:
+                    address = addresses.popleft()
+                    attempt = asyncio.ensure_future(self.connect_socket(*address), loop=self.loop)
+                    attempts[attempt] = address
+
+                    if addresses:
+                        timeout = self.happy_eyeballs_delay
+
+                    if len(attempts) > 1:
+                        self.counters['connect_raced'] += 1
+
+                done, pending = await asyncio.wait(list(attempts), timeout=timeout,
+                        loop=self.loop, return_when=asyncio.FIRST_COMPLETED)
+
+                winner = None
+                for attempt in done:
+                    address = attempts.pop(attempt)
+
+                    if attempt.exception():
+                        error = attempt.exception()
+                        self.connect_times[address[0]] = None
+                        self.counters['connect_failed'] += 1
+                    elif winner:
+                        attempt.result().close()
+                    else:
+                        winner = (attempt.result(), address)
+
+                if winner:
+                    return winner
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+                attempt.add_done_callback(close_socket)
+
+        raise error
+
+    async def connect_socket(self, ip, port):
+        """
+        Open a non-blocking socket connected to ``ip`` and ``port``.
+        """
+        if isinstance(ip, bytes):
+            ip = ip.decode()
+
+        if uvhttp.dns.is_ipv6(ip):
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+
+        try:
+            await self.loop.sock_connect(sock, (ip, port))
+        except:
+            sock.close()
+            raise
+
+        return sock
+
+    def ssl_context(self, connection):
+        """
+        Return the ``ssl`` argument for a new socket from ``connection``,
+        offering the cached TLS session for its server if there is one.
+        """
+        if self.tls_sessions is None:
+            return connection.ssl
+
+        if connection.ssl is True:
+            # Use a default context that can be wrapped.
+            if self.ssl is True:
+                self.ssl = ssl.create_default_context()
+
+            connection.ssl = self.ssl
+
+        session = self.tls_sessions.get((connection.host, connection.port))
+        if not session:
+            return connection.ssl
+
+        return SessionContext(connection.ssl, session)
+
+    def save_tls_session(self, connection):
+        """
+        Cache the TLS session of an open connection.
+        """
+        if self.tls_sessions is None:
+            return
+
+        ssl_object = connection.ssl_object()
+        if ssl_object and ssl_object.session:
+            self.tls_sessions[(connection.host, connection.port)] = ssl_object.session
+
+    def handshake_done(self, connection):
+        """
+        Count whether the TLS session offered to the server was resumed.
+        """
+        if self.tls_sessions is None:
+            return
+
+        ssl_object = connection.ssl_object()
+        if not ssl_object:
+            return
+
+        if ssl_object.session_reused:
+            self.counters['tls_resumed'] += 1
+        else:
+            self.counters['tls_full_handshakes'] += 1
+
+    def expired(self, connection, now):
+        """
+        Return the reason an open connection should be closed, or ``None`` if
+        it can still be used.
+        """
+        if self.max_requests and connection.requests >= self.max_requests:
+            return 'max_requests'
+
+        if self.max_lifetime and now - connection.connected_at >= self.max_lifetime:
+            return 'max_lifetime'
+
+        if self.idle_timeout and connection.idle and connection.last_used \
+          and now - connection.last_used >= self.idle_timeout:
+            return 'idle_timeout'
+
+    def reap(self, connection, reason):
+        """
+        Close an expired connection and open a new socket in its place if
+        ``replace_reaped`` is set.
+        """
+        connection.close()
+
+        self.counters['reaped'] += 1
+        self.counters['reaped_' + reason] += 1
+
+        if self.replace_reaped and connection.idle and not self.pool_available.locked():
+            asyncio.ensure_future(self.replace(connection), loop=self.loop)
+
+    async def replace(self, connection):
+        """
+        Reconnect an idle connection, holding it while it connects.
+        """
+        if not connection.idle or self.pool_available.locked():
+            return
+
+        await self.pool_available.acquire()
+
+        try:
+            self.idle_list(connection).remove(connection)
+        except ValueError:
+            pass
+
+        connection.acquire()
+
+        try:
+            await connection.connect()
+            self.counters['replaced'] += 1
+        except (OSError, asyncio.TimeoutError):
+            connection.close()
+        finally:
+            connection.requests = 0
+            connection.release()
+
+    async def reap_forever(self):
+        """
+        Periodically close idle connections that have expired. Stops once no
+        connection is open or in use, and is started again by :meth:`.connect`.
+        """
+        while True:
+            await asyncio.sleep(self.reap_interval, loop=self.loop)
+
+            if not any(connection.connected or not connection.idle for connection in self.pool):
+                self.reaper = None
+                return
+
+            now = self.loop.time()
+            for connection in list(self.pool):
+                if not connection.idle or not connection.connected:
+                    continue
+
+                reason = self.expired(connection, now)
+                if reason:
+                    self.reap(connection, reason)
+
+    def close(self):
+        """
+        Stop the background task and close all connections.
+        """
+        if self.reaper:
+            self.reaper.cancel()
+            self.reaper = None
+
+        for connection in self.pool:
+            connection.close()
+
+    async def stats(self, detailed=False):
         """
         Count how many times each Connection object reconnected to determine
         pool efficiency.
+
+        If ``detailed`` is true, a dictionary with the reconnect count under
+        ``connects`` and the pool's other counters (such as ``reaped``) is
+        returned instead. Queue depth and wait times for each priority are
+        under ``priorities``. If the pool balances requests, the connections
+        and requests in flight for each address are under ``addresses``.
         """
-        connections = 0
+        connections = self.retired_connects
 
         async with self.pool_lock:
             for connection in self.pool:
                 connections += connection.connect_count
 
+        if detailed:
+            stats = dict(self.counters)
+            stats['connects'] = connections
+
+            priorities = self.pool_available.stats()
+            if priorities:
+                stats['priorities'] = priorities
+
+            if self.subpools:
+                stats['addresses'] = {
+                    address: {
+                        'connections': len(subpool.connections),
+                        'outstanding': subpool.outstanding,
+                    } for address, subpool in self.subpools.items()
+                }
+
+            return stats
+
         return connections
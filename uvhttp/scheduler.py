@@ -0,0 +1,156 @@
+import asyncio
+import collections
+
+class FairScheduler:
+    """
+    Limits the number of requests in flight across a :class:`uvhttp.http.Session`
+    to ``limit``.
+
+    Requests that have to wait are queued by key (the session uses the
+    :class:`uvhttp.pool.Pool` of the request) and freed slots are handed out
+    to the keys in round-robin order, first in first out within a key, so that
+    a host with a long queue cannot starve the others.
+
+    Open keep-alive connections left idle by released requests count towards
+    the limit as well: once requests in flight plus idle connections exceed
+    it, the least recently used idle connections (of any host) are closed.
+    """
+    def __init__(self, limit, loop):
+        self.limit = limit
+        self.loop = loop
+
+        # Requests holding a slot.
+        self.active = 0
+
+        # Queues of waiting futures by key, in the order they are served.
+        self.waiters = collections.OrderedDict()
+        self.waiting = 0
+
+        # Open connections released by requests, least recently used first.
+        self.idle = collections.OrderedDict()
+
+        # Counters for scheduling events, see stats().
+        self.counters = collections.Counter()
+
+    async def acquire(self, key):
+        """
+        Wait for a slot for a request queued under ``key``.
+        """
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+
+        future = self.loop.create_future()
+
+        queue = self.waiters.get(key)
+        if queue is None:
+            queue = self.waiters[key] = collections.deque()
+
+        queue.append(future)
+        self.waiting += 1
+        self.counters['queued'] += 1
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.remove(key, future)
+            else:
+                # The slot was handed over as the wait was cancelled.
+                self.release()
+            raise
+
+    def remove(self, key, future):
+        """
+        Remove a cancelled ``future`` from the queue of ``key``.
+        """
+        queue = self.waiters.get(key)
+        if queue is None:
+            return
+
+        try:
+            queue.remove(future)
+        except ValueError:
+            return
+
+        self.waiting -= 1
+
+        if not queue:
+            del self.waiters[key]
+
+    def reserve(self, connection):
+        """
+        Called once a request holding a slot got ``connection``. Makes room
+        for the socket if it still has to be opened.
+        """
+        self.idle.pop(connection, None)
+
+        if not connection.connected:
+            self.trim()
+
+    def release(self, connection=None):
+        """
+        Free a slot, handing it to the next key with a waiting request.
+        ``connection`` is the connection the request used, if it was kept
+        open for reuse.
+        """
+        if connection is not None and connection.connected and connection.idle:
+            self.idle[connection] = None
+            self.idle.move_to_end(connection)
+
+        self.hand_over()
+        self.trim()
+
+    def hand_over(self):
+        """
+        Hand a freed slot to the next key with a waiting request.
+        """
+        while self.waiting:
+            key, queue = next(iter(self.waiters.items()))
+            future = queue.popleft()
+            self.waiting -= 1
+
+            # Move the key to the back of the line.
+            if queue:
+                self.waiters.move_to_end(key)
+            else:
+                del self.waiters[key]
+
+            # Cancelled, but not yet removed by its acquire().
+            if future.done():
+                continue
+
+            future.set_result(None)
+            return
+
+        self.active -= 1
+
+    def trim(self):
+        """
+        Close the least recently used idle connections while requests in
+        flight and idle connections exceed the limit.
+        """
+        # Forget connections that were reused or closed since, they do not
+        # hold an idle socket.
+        for connection in [ c for c in self.idle if not c.connected or not c.idle ]:
+            del self.idle[connection]
+
+        while self.idle and self.active + len(self.idle) > self.limit:
+            connection, _ = self.idle.popitem(last=False)
+            connection.close()
+            self.counters['closed_idle'] += 1
+
+    def stats(self):
+        """
+        Return the number of requests holding a slot (``active``), waiting
+        for one (``waiting``), how many keys are waiting (``keys``), the
+        number of requests that ever had to wait (``queued``), idle
+        connections tracked (``idle``) and closed to stay within the limit
+        (``closed_idle``).
+        """
+        stats = dict(self.counters)
+        stats['active'] = self.active
+        stats['idle'] = len(self.idle)
+        stats['waiting'] = self.waiting
+        stats['keys'] = len(self.waiters)
+        return stats
@@ -0,0 +1,304 @@
+import collections
+import multiprocessing
+import multiprocessing.connection
+import time
+import zlib
+from uvhttp.http import RequestMap, Session, split_origin
+from uvhttp.utils import start_loop, NUM_WORKERS
+
+class ShardedClient:
+    """
+    Sends requests from worker processes, each running its own event loop and
+    :class:`uvhttp.http.Session`, to use all cores::
+
+        import uvhttp.sharding
+
+        client = uvhttp.sharding.ShardedClient(conn_limit=10)
+
+        urls = (b'http://www.google.com/?q=' + str(i).encode() for i in range(100000))
+
+        for url, status_code in client.run(urls):
+            print(url, status_code)
+
+        print(client.stats())
+
+    Requests are handed to the workers in batches of ``batch_size``, sharded
+    by origin so that each host is only connected to from one worker and its
+    connections stay hot. Set ``shard_by=None`` to spread requests over the
+    workers in turn instead, for example when there are only a few hosts.
+    Requests are the same as for :meth:`uvhttp.http.Session.map`, except
+    that :class:`uvhttp.http.PreparedRequest` objects cannot be sent to other
+    processes.
+
+    Responses cannot leave the worker either, so ``handler`` is called with
+    each response in the worker and its result sent back (by default the
+    status code). A failed request (or handler) results in its error. Each
+    worker keeps up to ``concurrency`` requests in flight. Other keyword
+    arguments are passed to each worker's session.
+    """
+    def __init__(self, conn_limit=10, workers=NUM_WORKERS, concurrency=100, batch_size=100,
+                 shard_by='origin', handler=None, **session_kwargs):
+        self.conn_limit = conn_limit
+        self.workers = workers
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.shard_by = shard_by
+        self.handler = handler or status_code
+        self.session_kwargs = session_kwargs
+
+        # Requests that may be queued for or in flight in each worker before
+        # the next batch is held back.
+        self.max_pending = concurrency * 2 + batch_size
+
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.Counter()
+        self.latencies = []
+        self.worker_stats = []
+        self.duration = 0
+        self.batches = 0
+
+    def shard(self, request):
+        """
+        Return the index of the worker ``request`` should be sent from.
+        """
+        if self.shard_by != 'origin':
+            return self.batches % self.workers
+
+        url = request if isinstance(request, bytes) else request[1]
+        origin, path = split_origin(url)
+
+        # hash() of bytes differs between processes, crc32 does not.
+        return zlib.crc32(origin) % self.workers
+
+    def run(self, requests):
+        """
+        Send ``requests`` from the workers and yield ``(request, result)``
+        pairs as they complete. Statistics are available from :meth:`.stats`
+        once all of the pairs have been consumed.
+        """
+        self.reset()
+        start = time.time()
+
+        workers = []
+        for _ in range(self.workers):
+            requests_reader, requests_writer = multiprocessing.Pipe(duplex=False)
+            results_reader, results_writer = multiprocessing.Pipe(duplex=False)
+
+            process = multiprocessing.Process(target=work, args=(requests_reader,
+                results_writer, self.conn_limit, self.concurrency, self.batch_size,
+                self.handler, self.session_kwargs))
+            process.start()
+
+            workers.append(Worker(process, requests_writer, results_reader))
+
+        try:
+            buffers = [ [] for _ in workers ]
+
+            for request in requests:
+                shard = self.shard(request)
+
+                buffer = buffers[shard]
+                buffer.append(request)
+
+                if len(buffer) >= self.batch_size:
+                    yield from self.send(workers, shard, buffer)
+                    buffers[shard] = []
+
+            for shard, buffer in enumerate(buffers):
+                if buffer:
+                    yield from self.send(workers, shard, buffer)
+
+                workers[shard].requests.send(None)
+
+            while not all(worker.done for worker in workers):
+                yield from self.receive(workers)
+        finally:
+            for worker in workers:
+                if not worker.done:
+                    worker.process.terminate()
+
+                worker.process.join()
+
+        self.duration = time.time() - start
+
+    def send(self, workers, shard, batch):
+        """
+        Send ``batch`` to the worker ``shard`` once it has room for it,
+        yielding the results that arrive in the meantime.
+        """
+        worker = workers[shard]
+
+        yield from self.receive(workers, timeout=0)
+
+        while worker.pending >= self.max_pending:
+            yield from self.receive(workers)
+
+        worker.requests.send(batch)
+        worker.pending += len(batch)
+        self.batches += 1
+
+    def receive(self, workers, timeout=None):
+        """
+        Yield the results that the workers sent, waiting up to ``timeout``
+        seconds for them.
+        """
+        readers = { worker.results: worker for worker in workers if not worker.done }
+
+        for reader in multiprocessing.connection.wait(list(readers), timeout):
+            worker = readers[reader]
+            message, payload = reader.recv()
+
+            if message == 'done':
+                worker.done = True
+                self.worker_stats.append(payload)
+                continue
+
+            worker.pending -= len(payload)
+
+            for request, result, latency in payload:
+                self.counters['requests'] += 1
+
+                if latency is None:
+                    self.counters['errors'] += 1
+                else:
+                    self.latencies.append(latency)
+
+                yield request, result
+
+    def stats(self):
+        """
+        Return the number of ``requests`` and ``errors``, the ``duration`` of
+        the last run, requests per second (``rps``), latency percentiles in
+        seconds (``latency``) and the pool counters of all workers added up
+        (``pools``).
+        """
+        stats = dict(self.counters)
+        stats['duration'] = self.duration
+        stats['rps'] = self.counters['requests'] / self.duration if self.duration else 0
+
+        latencies = sorted(self.latencies)
+        if latencies:
+            stats['latency'] = {
+                'avg': sum(latencies) / len(latencies),
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1]
+            }
+
+        pools = collections.Counter()
+        for worker_stats in self.worker_stats:
+            pools.update(worker_stats)
+
+        stats['pools'] = dict(pools)
+        return stats
+
+class Worker:
+    """
+    The pipes to and from a worker process and how many requests it has yet
+    to return.
+    """
+    def __init__(self, process, requests, results):
+        self.process = process
+        self.requests = requests
+        self.results = results
+        self.pending = 0
+        self.done = False
+
+class TimedRequestMap(RequestMap):
+    """
+    A :class:`uvhttp.http.RequestMap` that returns how long each request
+    took along with its response.
+    """
+    async def send(self, request):
+        # The loop's clock is too coarse with uvloop.
+        start = time.monotonic()
+        response = await super().send(request)
+        return response, time.monotonic() - start
+
+class PipeReader:
+    """
+    Asynchronous iterator over the requests in the batches a worker receives,
+    read from the pipe in a thread so the event loop is not blocked.
+    """
+    def __init__(self, pipe, loop):
+        self.pipe = pipe
+        self.loop = loop
+        self.batch = collections.deque()
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.batch:
+            if self.done:
+                raise StopAsyncIteration
+
+            batch = await self.loop.run_in_executor(None, self.pipe.recv)
+            if batch is None:
+                self.done = True
+            else:
+                self.batch.extend(batch)
+
+        return self.batch.popleft()
+
+def work(requests, results, conn_limit, concurrency, batch_size, handler, session_kwargs):
+    """
+    Worker process: send the requests read from ``requests`` and write the
+    results to ``results`` in batches, then the worker's pool counters.
+    """
+    @start_loop
+    async def main(loop):
+        async def send(message):
+            # Written in a thread as the pipe blocks once it is full.
+            await loop.run_in_executor(None, results.send, message)
+
+        session = Session(conn_limit, loop, **session_kwargs)
+        responses = TimedRequestMap(session, PipeReader(requests, loop), concurrency,
+            False, True)
+
+        batch = []
+        async for request, result in responses:
+            try:
+                if isinstance(result, Exception):
+                    raise result
+
+                response, latency = result
+                batch.append((request, handler(response), latency))
+            except Exception as e:
+                batch.append((request, e, None))
+
+            # Send once the batch is full or there is nothing else in flight.
+            if len(batch) >= batch_size or responses.taken == responses.yielded:
+                await send(('results', batch))
+                batch = []
+
+        if batch:
+            await send(('results', batch))
+
+        counters = collections.Counter()
+        for pool in session.hosts.values():
+            stats = await pool.stats(detailed=True)
+            counters.update({ name: value for name, value in stats.items()
+                if isinstance(value, (int, float)) })
+
+        session.close()
+        await send(('done', dict(counters)))
+
+    main()
+
+def status_code(response):
+    """
+    The default handler of :class:`.ShardedClient`.
+    """
+    return response.status_code
+
+def percentile(values, percent):
+    """
+    Return the ``percent`` percentile of the sorted list ``values``.
+    """
+    index = int(len(values) * percent / 100)
+    return values[min(index, len(values) - 1)]
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from uvhttp.http import Session
+
+class Client:
+    """
+    A blocking HTTP client for synchronous code. The client runs an event
+    loop with a :class:`uvhttp.http.Session` in a background thread, so
+    connections and DNS lookups are reused from one call to the next::
+
+        import uvhttp.sync
+
+        client = uvhttp.sync.Client(10)
+
+        response = client.get(b'http://www.google.com/')
+        print(response.text)
+
+        client.close()
+
+    The client can be used from several threads at once. Responses are read
+    in full before they are returned, so ``stream`` is not supported. All
+    other arguments are passed to the session.
+    """
+    def __init__(self, conn_limit=10, **session_kwargs):
+        self.loop = asyncio.new_event_loop()
+
+        self.thread = threading.Thread(target=self.run, name='uvhttp', daemon=True)
+        self.thread.start()
+
+        self.session = self.call(self.create_session(conn_limit, session_kwargs))
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def create_session(self, conn_limit, session_kwargs):
+        return Session(conn_limit, self.loop, **session_kwargs)
+
+    def call(self, coro):
+        """
+        Run ``coro`` on the client's loop and return its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def head(self, *args, **kwargs):
+        """
+        Make an HTTP HEAD request to url, see :meth:`.request`.
+        """
+        return self.request(b'HEAD', *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        """
+        Make an HTTP GET request to url, see :meth:`.request`.
+        """
+        return self.request(b'GET', *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        """
+        Make an HTTP POST request to url, see :meth:`.request`.
+        """
+        return self.request(b'POST', *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        """
+        Make an HTTP PUT request to url, see :meth:`.request`.
+        """
+        return self.request(b'PUT', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """
+        Make an HTTP DELETE request to url, see :meth:`.request`.
+        """
+        return self.request(b'DELETE', *args, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Make an HTTP request and wait for the response, see
+        :meth:`uvhttp.http.Session.request`.
+        """
+        return self.call(self.session.request(method, url, **kwargs))
+
+    def map(self, requests, concurrency=10, ordered=False, return_exceptions=False):
+        """
+        Send ``requests`` with at most ``concurrency`` in flight and yield
+        ``(request, response)`` pairs, see :meth:`uvhttp.http.Session.map`.
+        ``requests`` is read from the client's thread.
+        """
+        results = self.session.map(requests, concurrency=concurrency, ordered=ordered,
+            return_exceptions=return_exceptions)
+
+        try:
+            while True:
+                try:
+                    yield self.call(results.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.loop.call_soon_threadsafe(results.close)
+
+    def close(self):
+        """
+        Close the session and stop the client's thread.
+        """
+        if not self.thread.is_alive():
+            return
+
+        self.loop.call_soon_threadsafe(self.session.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
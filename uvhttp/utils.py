@@ -32,9 +32,11 @@ def run_workers(func):
     else:
         func()
 
+@functools.lru_cache(maxsize=4096)
 def is_ip(host):
     """
-    Return True if ``host`` is an IPv4 or IPv6 address.
+    Return True if ``host`` is an IPv4 or IPv6 address. Results are cached
+    for the most recently checked hosts.
     """
     if isinstance(host, bytes):
         host = host.decode()
@@ -51,26 +53,118 @@ def is_ip(host):
     except socket.error:
         return False
 
+async def wait_for(coro, deadline, loop):
+    """
+    Await ``coro``, raising :class:`asyncio.TimeoutError` if ``deadline`` (in
+    loop time) passes first. There is no overhead if ``deadline`` is ``None``.
+    """
+    if deadline is None:
+        return await coro
+
+    return await asyncio.wait_for(coro, max(deadline - loop.time(), 0), loop=loop)
+
 class HeaderDict:
-    def __init__(self, original):
-        self.__dict = dict([ (k.upper(), (k, v)) for k, v in original.items() ])
+    """
+    Case-insensitive, read-only view of HTTP headers that keeps every
+    ``(name, value)`` pair in the order it was received, including repeated
+    headers such as ``Set-Cookie``.
+
+    ``headers`` is a list of pairs or a dictionary. A list is used as is, so
+    pairs appended to it later are seen as well. Lowercase keys are only
+    computed, once per pair, when a header is first looked up.
+
+    Looking up a missing header returns ``b''``. If a header was received
+    more than once, the last value is returned, use :meth:`.getall` for all
+    of them. Iterating, :meth:`.keys`, :meth:`.values`, :meth:`.items` and
+    ``len()`` all count repeated headers once per pair.
+    """
+    def __init__(self, headers=None):
+        if headers is None:
+            headers = []
+        elif not isinstance(headers, list):
+            headers = list(headers.items())
+
+        self.pairs = headers
+
+        # Values by lowercase name, for the first ``indexed`` pairs.
+        self.index = {}
+        self.indexed = 0
+
+    def lookup(self):
+        """
+        Return the index of values by lowercase name, adding any pairs that
+        arrived since it was last used.
+        """
+        if self.indexed < len(self.pairs):
+            index = self.index
+
+            for name, value in self.pairs[self.indexed:]:
+                key = name.lower()
+
+                values = index.get(key)
+                if values is None:
+                    index[key] = [ value ]
+                else:
+                    values.append(value)
+
+            self.indexed = len(self.pairs)
+
+        return self.index
 
     def __getitem__(self, key):
-        try:
-            return self.__dict[key.upper()][1]
-        except KeyError:
+        values = self.lookup().get(key.lower())
+        if values is None:
             return b''
 
+        return values[-1]
+
+    def get(self, key, default=None):
+        """
+        Return the last value of the header ``key``, or ``default`` if it was
+        not received.
+        """
+        values = self.lookup().get(key.lower())
+        if values is None:
+            return default
+
+        return values[-1]
+
+    def getall(self, key):
+        """
+        Return a list of every value of the header ``key``, in the order they
+        were received.
+        """
+        return list(self.lookup().get(key.lower(), ()))
+
+    def __contains__(self, key):
+        return key.lower() in self.lookup()
+
+    def __len__(self):
+        return len(self.pairs)
+
     def __iter__(self):
-        for value in self.__dict.values():
-            yield value[0]
+        """
+        Iterate over the header names in the order they were received,
+        including repeated ones.
+        """
+        for name, value in self.pairs:
+            yield name
 
     def keys(self):
         return [ key for key in self ]
 
+    def values(self):
+        """
+        Return the values of all headers, including repeated ones.
+        """
+        return [ value for name, value in self.pairs ]
+
     def items(self):
-        for key, value in self.__dict.items:
-            yield value
+        """
+        Return the ``(name, value)`` pairs of all headers, including repeated
+        ones, in the order they were received.
+        """
+        return list(self.pairs)
 
 class HttpServer:
     """